@@ -0,0 +1,78 @@
+import os
+import sys
+import json
+import shutil
+import logging
+import argparse
+import tempfile
+from storage.storagemanager import initStorageManager, LocalStorage
+from benchmarks import suite
+
+# Runs the benchmarks from BuildingDetector/src/:
+#
+#   python -m benchmarks                    run everything, compare with the baseline if there is one
+#   python -m benchmarks --save-baseline    also store the results as the new baseline
+#   python -m benchmarks --only mercator_quadtree --max-n 10000
+#
+# Exits with status 1 if any benchmark is slower than the baseline by more than --threshold.
+
+OUTPUT_DIR = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../output/benchmarks"))
+
+def main():
+    parser = argparse.ArgumentParser(description='Micro-benchmarks of the hot functions')
+    parser.add_argument('--only',           type=str,   nargs='+', choices=list(suite.BENCHMARKS), help='Only run these benchmarks')
+    parser.add_argument('--repeat',         type=int,   default=5, help='Timed runs of each size')
+    parser.add_argument('--max-n',          type=int,   help='Skip sizes larger than this')
+    parser.add_argument('--output',         type=str,   default=os.path.join(OUTPUT_DIR, 'latest.json'), help='Where to write the results')
+    parser.add_argument('--baseline',       type=str,   default=os.path.join(OUTPUT_DIR, 'baseline.json'), help='Results to compare with')
+    parser.add_argument('--save-baseline',  action='store_true', help='Store the results as the baseline')
+    parser.add_argument('--threshold',      type=float, default=0.25, help='Slowdown (as a fraction) that counts as a regression')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s', stream=sys.stdout)
+
+    # Anything the benchmarks store goes to a scratch folder
+    workdir = tempfile.mkdtemp(prefix='benchmarks_')
+    try:
+        initStorageManager('benchmarks', LocalStorage('benchmarks', root=workdir))
+        results = suite.run(workdir, args.only, args.repeat, args.max_n)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    for name, result in results['benchmarks'].items():
+        if result['exponent'] is not None:
+            logging.info("%-28s scales as n^%.2f" % (name, result['exponent']))
+
+    _write(args.output, results)
+    if args.save_baseline:
+        _write(args.baseline, results)
+        return 0
+
+    if not os.path.exists(args.baseline):
+        logging.info("No baseline at %s, run with --save-baseline to create one" % args.baseline)
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+
+    rows, regressions = suite.compare(results, baseline, args.threshold)
+    logging.info("")
+    logging.info("%-28s %8s %12s %12s %8s" % ('benchmark', 'n', 'baseline', 'current', 'ratio'))
+    for row in rows:
+        logging.info("%-28s %8i %11.4fs %11.4fs %7.2fx%s" % (row + (' REGRESSION' if row in regressions else '',)))
+
+    if regressions:
+        logging.info("%i regressions against %s" % (len(regressions), args.baseline))
+        return 1
+    return 0
+
+def _write(filename, results):
+    directory = os.path.dirname(os.path.abspath(filename))
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(filename, 'w') as f:
+        json.dump(results, f, indent=2)
+    logging.info("Results written to %s" % filename)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,118 @@
+import os
+import struct
+import numpy
+from PIL import Image, ImageDraw
+from mapping.tilemanager import AbstractTileManager
+
+# Synthetic inputs for the benchmarks. Everything is generated from SEED and the
+# size, so every run (and every machine) times exactly the same work.
+
+SEED        = 1234
+CENTRE      = (45.39, -75.70)     # lat, lon of the README's example area
+ZOOM        = 19
+TILE_SIZE   = 256
+
+def random_state(n, salt=0):
+    return numpy.random.RandomState([SEED, n, salt])
+
+# An OSM API map response with n square buildings (four nodes each) and as many
+# untagged ways, which the parser has to skip
+def osm_document(n):
+    random  = random_state(n)
+    lats    = CENTRE[0] + random.uniform(-0.05, 0.05, n)
+    lons    = CENTRE[1] + random.uniform(-0.05, 0.05, n)
+    sizes   = random.uniform(0.00005, 0.0002, n)
+
+    parts   = ['<?xml version="1.0" encoding="UTF-8"?><osm version="0.6">']
+    node_id = 0
+    for index in range(n):
+        refs = []
+        for corner_lat, corner_lon in [(0, 0), (0, 1), (1, 1), (1, 0)]:
+            node_id += 1
+            parts.append('<node id="%i" visible="true" version="1" lat="%.7f" lon="%.7f"/>' % (node_id, lats[index] + corner_lat * sizes[index], lons[index] + corner_lon * sizes[index]))
+            refs.append(node_id)
+
+        nds = ''.join('<nd ref="%i"/>' % ref for ref in refs + refs[:1])
+        parts.append('<way id="%i" visible="true" version="1">%s<tag k="building" v="yes"/></way>' % (2 * index + 1, nds))
+        parts.append('<way id="%i" visible="true" version="1">%s<tag k="highway" v="service"/></way>' % (2 * index + 2, nds))
+
+    parts.append('</osm>')
+    return ''.join(parts)
+
+# n detections as the [[lat, lon], [lat, lon]] corner pairs Detect writes out
+def building_corners(n):
+    random  = random_state(n)
+    lats    = CENTRE[0] + random.uniform(-0.05, 0.05, n)
+    lons    = CENTRE[1] + random.uniform(-0.05, 0.05, n)
+    sizes   = random.uniform(0.00005, 0.0002, n)
+    return [[[lats[index], lons[index]], [lats[index] - sizes[index], lons[index] + sizes[index]]] for index in range(n)]
+
+# (lats, lons) of n points around CENTRE
+def lat_lons(n):
+    random = random_state(n)
+    return CENTRE[0] + random.uniform(-1, 1, n), CENTRE[1] + random.uniform(-1, 1, n)
+
+# n (x, y) TMS tiles at ZOOM around CENTRE
+def tiles(n):
+    random = random_state(n)
+    return zip(random.randint(150000, 160000, n), random.randint(370000, 380000, n))
+
+# Pixel bounds (ll_p_x, ll_p_y, ur_p_x, ur_p_y) of a square area of about n tiles at ZOOM
+def pixel_bounds(n):
+    side    = int(round(numpy.sqrt(n))) * TILE_SIZE
+    ll_p_x  = 152000 * TILE_SIZE + 100
+    ll_p_y  = 375000 * TILE_SIZE + 100
+    return ll_p_x, ll_p_y, ll_p_x + side, ll_p_y + side
+
+# A textured RGB image of about n tiles with bright building-like rectangles on it,
+# and the uint8 mask of the buildings (1 = building)
+def aerial_image(n):
+    random  = random_state(n)
+    side    = int(round(numpy.sqrt(n))) * TILE_SIZE
+
+    pixels  = random.randint(60, 120, (side, side, 3)).astype(numpy.uint8)
+    mask    = numpy.zeros((side, side), dtype=numpy.uint8)
+    count   = side * side // 20000
+    lefts   = random.randint(0, side - 80, count)
+    tops    = random.randint(0, side - 80, count)
+    sizes   = random.randint(20, 80, count)
+    for left, top, size in zip(lefts, tops, sizes):
+        pixels[top:top + size, left:left + size] = 200
+        mask[top:top + size, left:left + size] = 1
+
+    return Image.fromarray(pixels), mask
+
+# count small images, half with a building outline (straight lines) and half plain texture
+def line_crops(count, size=64):
+    random  = random_state(count)
+    crops   = []
+    for index in range(count):
+        image = Image.fromarray(random.randint(60, 120, (size, size, 3)).astype(numpy.uint8))
+        if index % 2 == 0:
+            inset = random.randint(4, size // 4)
+            ImageDraw.Draw(image).rectangle([inset, inset, size - inset, size - inset], outline=(230, 230, 230))
+        crops.append(image)
+    return crops
+
+# Writes files .vec files (the opencv_createsamples format) holding n 24x24 samples between them
+def vec_files(directory, n, files=10, width=24, height=24):
+    random  = random_state(n)
+    size    = width * height
+    for index in range(files):
+        count   = n // files + (1 if index < n % files else 0)
+        samples = random.randint(0, 255, (count, size)).astype('<i2')
+        with open(os.path.join(directory, "samples_%02i.vec" % index), 'wb') as f:
+            f.write(struct.pack('<iihh', count, size, 0, 0))
+            for sample in samples:
+                f.write('\0' + sample.tostring())
+
+
+# Serves a few pre-built textured tiles, so stitching benchmarks time the stitching and not the source
+class FixtureTileManager(AbstractTileManager):
+
+    def __init__(self, count=16):
+        random      = random_state(count)
+        self.tiles  = [Image.fromarray(random.randint(0, 255, (TILE_SIZE, TILE_SIZE, 3)).astype(numpy.uint8)) for index in range(count)]
+
+    def get_tile(self, x, y, zoom):
+        return self.tiles[(x * 7 + y) % len(self.tiles)]
@@ -0,0 +1,221 @@
+import gc
+import os
+import sys
+import time
+import timeit
+import logging
+import platform
+import collections
+import numpy
+from benchmarks import fixtures
+
+# Micro-benchmarks of the hot functions, each timed over a range of input sizes.
+#
+# A benchmark is a setup function registered with @benchmark. setup(n) builds
+# the fixtures for size n (untimed) and returns the function to time, which is
+# called with no arguments. Every size is run once to warm up, then timed
+# `repeat` times. The fastest time is used for comparisons as it is the least
+# affected by other load on the machine.
+
+SIZES       = [100, 1000, 10000, 100000]
+# Image benchmarks count 256 pixel tiles, larger sizes don't fit in memory
+IMAGE_SIZES = [16, 100, 400]
+
+BENCHMARKS  = collections.OrderedDict()
+
+def benchmark(name, sizes=SIZES):
+    def register(setup):
+        BENCHMARKS[name] = (sizes, setup)
+        return setup
+    return register
+
+
+@benchmark('osm_process_building_data')
+def _osmProcessBuildingData(n):
+    import xml.etree.cElementTree as ET
+    from mapping.osmmanager import OSMManager
+
+    manager         = OSMManager()
+    building_data   = ET.fromstring(fixtures.osm_document(n))
+    return lambda: manager._processBuildingData(building_data)
+
+@benchmark('osm_generate_output_xml')
+def _osmGenerateOutputXml(n):
+    from mapping.osmmanager import OSMManager
+
+    manager     = OSMManager()
+    buildings   = fixtures.building_corners(n)
+    return lambda: manager.generateOutputXml(45.34, -75.75, 45.44, -75.65, buildings)
+
+# Lat/lon to pixels and back, the conversions used for every building and tile
+@benchmark('mercator_conversions')
+def _mercatorConversions(n):
+    from mapping.tileutils import GlobalMercator
+
+    mercator    = GlobalMercator()
+    lats, lons  = fixtures.lat_lons(n)
+    points      = zip(lats.tolist(), lons.tolist())
+
+    def run():
+        for lat, lon in points:
+            p_x, p_y = mercator.MetersToPixels(*mercator.LatLonToMeters(lat, lon) + (fixtures.ZOOM,))
+            mercator.PixelsToTile(p_x, p_y)
+            mercator.MetersToLatLon(*mercator.PixelsToMeters(p_x, p_y, fixtures.ZOOM))
+    return run
+
+@benchmark('mercator_quadtree')
+def _mercatorQuadTree(n):
+    from mapping.tileutils import GlobalMercator
+
+    mercator    = GlobalMercator()
+    tiles       = fixtures.tiles(n)
+    return lambda: [mercator.QuadTree(x, y, fixtures.ZOOM) for x, y in tiles]
+
+@benchmark('generate_static_map', IMAGE_SIZES)
+def _generateStaticMap(n):
+    from mapping.tilemanager import StaticMapGenerator
+
+    generator = StaticMapGenerator([fixtures.ZOOM], tile_manager=fixtures.FixtureTileManager())
+    ll_p_x, ll_p_y, ur_p_x, ur_p_y = fixtures.pixel_bounds(n)
+
+    def run():
+        generator.set_pixel_bounds(ll_p_x, ll_p_y, ur_p_x, ur_p_y, fixtures.ZOOM)
+        return generator.generate_static_map()
+    return run
+
+# Choosing and cropping the negative samples of a mosaic, including storing the crops
+@benchmark('train_negative_samples', IMAGE_SIZES)
+def _trainNegativeSamples(n):
+    from train import Train
+    from storage.storagemanager import getStorageManager
+
+    train               = Train(fixtures.FixtureTileManager())
+    tile_image, mask    = fixtures.aerial_image(n)
+    calls               = [0]
+
+    # Existing crops aren't stored again, so every call uses a new tile ID
+    def run():
+        calls[0] += 1
+        train._getNegativeSamples('benchmark_%i_%i' % (n, calls[0]), tile_image, mask)
+        getStorageManager().flush()
+    return run
+
+# n calls, each on a different crop so nothing is reused between calls
+@benchmark('detect_lines_in_image', SIZES[:3])
+def _detectLinesInImage(n):
+    from detect import Detect
+
+    detect  = Detect(fixtures.FixtureTileManager())
+    crops   = fixtures.line_crops(min(n, 100))
+    return lambda: [detect._isLinesInImage(crops[index % len(crops)]) for index in range(n)]
+
+# Merging .vec files holding n samples between them
+@benchmark('merge_vec_files')
+def _mergeVecFiles(n):
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../tools'))
+    from mergevec import merge_vec_files
+
+    directory = os.path.join(_workdir, 'vec_%i' % n)
+    os.makedirs(directory)
+    fixtures.vec_files(directory, n)
+    output = os.path.join(_workdir, 'merged_%i.vec' % n)
+    return lambda: merge_vec_files(directory, output)
+
+
+# Scratch folder for benchmarks that write files (set by run)
+_workdir = None
+
+# Runs the benchmarks (all of them, or those named) and returns the results as a
+# dict that can be stored as JSON. Sizes above max_n are skipped.
+def run(workdir, names=None, repeat=5, max_n=None):
+    global _workdir
+    _workdir = workdir
+
+    unknown = set(names or []) - set(BENCHMARKS)
+    if unknown:
+        raise ValueError("Unknown benchmarks: %s" % ', '.join(sorted(unknown)))
+
+    results = collections.OrderedDict()
+    for name, (sizes, setup) in BENCHMARKS.items():
+        if names and name not in names:
+            continue
+
+        timings = collections.OrderedDict()
+        for n in sizes:
+            if max_n is not None and n > max_n:
+                continue
+
+            function = setup(n)
+            function()
+
+            times = []
+            for index in range(repeat):
+                start = timeit.default_timer()
+                function()
+                times.append(timeit.default_timer() - start)
+
+            timings[str(n)] = {
+                'min'       : min(times),
+                'median'    : float(numpy.median(times)),
+                'per_item'  : min(times) / n
+                }
+            logging.info("%-28s n=%-7i min %10.4fs  median %10.4fs  %8.2fus per item" % (name, n, min(times), numpy.median(times), 1e6 * min(times) / n))
+
+            del function
+            gc.collect()
+
+        results[name] = {
+            'sizes'     : timings,
+            'exponent'  : _scalingExponent(timings)
+            }
+
+    return {
+        'meta'          : {
+            'created'   : time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python'    : platform.python_version(),
+            'numpy'     : numpy.__version__,
+            'opencv'    : _opencvVersion(),
+            'platform'  : platform.platform(),
+            'repeat'    : repeat
+            },
+        'benchmarks'    : results
+        }
+
+# Compares results with a baseline from an earlier run. A size is a regression
+# if its fastest time is more than threshold (a fraction) slower and at least
+# min_seconds slower, so tiny timings don't trip on noise.
+# Returns (rows, regressions), each row (name, n, baseline, current, ratio).
+def compare(results, baseline, threshold=0.25, min_seconds=0.001):
+    rows        = []
+    regressions = []
+
+    for name, result in results['benchmarks'].items():
+        baseline_sizes = baseline['benchmarks'].get(name, {}).get('sizes', {})
+        for n, timing in result['sizes'].items():
+            if n not in baseline_sizes:
+                continue
+
+            before  = baseline_sizes[n]['min']
+            after   = timing['min']
+            row     = (name, int(n), before, after, after / before if before > 0 else float('inf'))
+            rows.append(row)
+
+            if after > before * (1 + threshold) and after - before >= min_seconds:
+                regressions.append(row)
+
+    return rows, regressions
+
+# Slope of log(time) against log(n): about 1 for linear work, 2 for quadratic
+def _scalingExponent(timings):
+    if len(timings) < 2:
+        return None
+    sizes = numpy.log([float(n) for n in timings])
+    times = numpy.log([max(timing['min'], 1e-9) for timing in timings.values()])
+    return float(numpy.polyfit(sizes, times, 1)[0])
+
+def _opencvVersion():
+    try:
+        import cv2
+        return cv2.__version__
+    except ImportError:
+        return None
@@ -1,12 +1,23 @@
-import logging
-import cv2
-import numpy 
+import copy
 import math
+import Queue
+import logging
+import cStringIO
+import collections
+import numpy
 from PIL import ImageDraw
-from shapely.geometry import LineString
 from mapping.tilemanager import StaticMapGenerator
 from mapping.osmmanager import OSMManager
+from mapping.tileplan import TilePlan
+from mapping.spatialindex import BoxIndex
 from storage.storagemanager import getStorageManager
+from detection.cascadeengine import CascadeEngine
+from detection.candidatecache import CandidateCache
+from detection.ensembleengine import EnsembleEngine
+from detection.linefilter import LineFilter
+from detection.tileresultcache import TileResultCache
+from storage.resultstore import ResultStore
+from multiprocessing.pool import ThreadPool
 
 class Detect:
 
@@ -31,20 +42,415 @@ class Detect:
     LINE_THRESHOLD  = 30    # Reduce to make less sensitive (lets more detections through)
     MIN_LINE_LENGTH = 20    # Reduce to make less sensitive (lets more detections through)
 
-    def __init__(self):
-        self.map_generator  = StaticMapGenerator([19]) # TODO: Assuming zoom level 19 is available
+    # The cascade only scans window sizes near MIN/MAX_WIDTH/HEIGHT (see
+    # detection/cascadeengine.py), which is much faster. Candidates outside the
+    # bounds are no longer grouped with the ones inside, so the detections can
+    # change (check with evaluate.py). Set to False for the unbounded scan's output.
+    BOUND_PYRAMID   = True
+
+    # Areas of near uniform colour (water, blank or missing imagery) are skipped
+    # before the cascade runs. The remaining regions are scanned separately,
+    # which moves the pyramid levels and window origins, so the detections can
+    # differ slightly from a full scan - hence disabled by default.
+    SKIP_UNIFORM    = False
+    UNIFORM_STDDEV  = 4     # Increase to skip more of the image
+
+    # Every run is also recorded in the results database (see storage/resultstore.py)
+    RECORD_RESULTS  = True
+
+    # Detections are stored per imagery tile (see detection/tileresultcache.py),
+    # so a re-run only runs the detector over tiles whose imagery, or the imagery
+    # around them, has changed
+    INCREMENTAL     = True
+
+    # Caches the raw cascade output of each mosaic (see detection/candidatecache.py)
+    # so MIN_NEIGHBORS and the size limits can be tuned without running the
+    # cascade again. This writes a file for every window and nothing removes
+    # them, so it is only turned on while tuning.
+    CACHE_CANDIDATES = False
+
+    # Detections that overlap a building already in OSM by at least CONFLATE_IOU
+    # are dropped from the output ('drop') or kept with a fixme tag and drawn in
+    # red ('flag'), so only new buildings need reviewing. None turns this off.
+    CONFLATE        = None
+    CONFLATE_IOU    = 0.3
+
+    # When several train IDs are given, a building is kept in the combined
+    # output if at least this many of their cascades found it
+    MIN_VOTES       = 1
+
+    # Threads fetching imagery and stored tile results
+    THREADS         = 8
+
+    # train_ids runs the cascades of several training sets over the same
+    # imagery. Each cascade's buildings are written to '<name>.<train_id>.xml'
+    # and the combined buildings to the usual output files.
+    def __init__(self, tile_manager=None, train_ids=None, zoom=19):
+        self.map_generator  = StaticMapGenerator([zoom], tile_manager=tile_manager)
         self.osmmanager     = OSMManager()
         self.storagemanager = getStorageManager()
-
-    def processTiles(self, tiles):
-        tile_count = 1
+        self.train_ids      = train_ids
+        self.engine         = None
+        self.engines        = {}
+        self.ensemble       = None
+        self.line_filter    = None
+        self.results        = None
+        self.tile_results   = TileResultCache(self.storagemanager)
+        # Pool the imagery and stored tile results are fetched on, started on first use
+        self._pool          = None
+
+        # Copies of this Detect that run the in-memory calls (see detectArray)
+        self._idle_workers  = Queue.Queue()
+
+    # In-memory API, for callers that already have the imagery. Nothing is
+    # downloaded, cached or written (other than loading the cascade once).
+    #
+    # image is an (height, width, 3) RGB uint8 array, used as is (without a copy)
+    # when it is C contiguous, or a PIL image. Returns an (n, 4) int32 array of
+    # left, top, width, height pixel boxes.
+    #
+    # Calls can be made from several threads at once. Each call is run by a copy
+    # of this Detect with its own cascade, made with the settings of the time.
+    def detectArray(self, image):
+        pixels = numpy.asarray(image)
+        if pixels.ndim != 3 or pixels.shape[2] != 3:
+            raise ValueError("Expected an (height, width, 3) RGB image, got shape %s" % (pixels.shape,))
+        pixels = numpy.ascontiguousarray(pixels, dtype=numpy.uint8)
+
+        worker = self._acquireWorker()
+        try:
+            buildings = worker._detectImage(pixels)[None]
+        finally:
+            self._idle_workers.put(worker)
+
+        return numpy.array(buildings, dtype=numpy.int32).reshape(-1, 4)
+
+    # detectArray for an image covering tile_coords, (min_lon, min_lat, max_lon, max_lat),
+    # in web mercator (north up, like the imagery tiles). Returns a list of dicts
+    # with the min_lon, min_lat, max_lon, max_lat of each building.
+    def detectRecords(self, image, tile_coords):
+        buildings   = self.detectArray(image)
+        height, width = numpy.asarray(image).shape[:2]
+
+        mercator    = self.map_generator.mercator
+        min_lon, min_lat, max_lon, max_lat = [float(value) for value in tile_coords]
+        min_x, min_y = mercator.LatLonToMeters(min_lat, min_lon)
+        max_x, max_y = mercator.LatLonToMeters(max_lat, max_lon)
+        scale_x     = (max_x - min_x) / width
+        scale_y     = (max_y - min_y) / height
+
+        records = []
+        for left, top, building_width, building_height in buildings:
+            building_min_lat, building_min_lon = mercator.MetersToLatLon(min_x + left * scale_x, max_y - (top + building_height) * scale_y)
+            building_max_lat, building_max_lon = mercator.MetersToLatLon(min_x + (left + building_width) * scale_x, max_y - top * scale_y)
+            records.append({
+                'min_lon'   : building_min_lon,
+                'min_lat'   : building_min_lat,
+                'max_lon'   : building_max_lon,
+                'max_lat'   : building_max_lat
+                })
+        return records
+
+    # Runs detectArray (for images) or detectRecords (for (image, tile_coords)
+    # pairs) over an iterable, on a pool of threads (OpenCV releases the GIL).
+    # Yields the results in order. Only a few items are read ahead, so items can
+    # be a generator over more imagery than fits in memory.
+    def detectMany(self, items, threads=4):
+        pool    = ThreadPool(threads)
+        pending = collections.deque()
+        try:
+            for item in items:
+                if isinstance(item, tuple):
+                    pending.append(pool.apply_async(self.detectRecords, item))
+                else:
+                    pending.append(pool.apply_async(self.detectArray, (item,)))
+
+                if len(pending) >= 2 * threads:
+                    yield pending.popleft().get()
+
+            while pending:
+                yield pending.popleft().get()
+        finally:
+            pool.close()
+            pool.join()
+
+    # Stops the fetching threads and those of the cascade ensemble, including the
+    # ensembles of the copies made by detectArray. The Detect can still be used afterwards.
+    def close(self):
+        while True:
+            try:
+                self._idle_workers.get_nowait()._closeEnsemble()
+            except Queue.Empty:
+                break
+        self._closeEnsemble()
+
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def _closeEnsemble(self):
+        if self.ensemble is not None:
+            self.ensemble.close()
+            self.ensemble = None
+
+    def _acquireWorker(self):
+        try:
+            return self._idle_workers.get_nowait()
+        except Queue.Empty:
+            # OpenCV cascades can't be used by two threads at once, so each worker loads its own
+            worker                  = copy.copy(self)
+            worker.engine           = None
+            worker.engines          = {}
+            worker.ensemble         = None
+            worker.line_filter      = None
+            worker.CACHE_CANDIDATES = False
+            return worker
+
+    # Detects buildings in every rectangle. Overlapping rectangles are planned
+    # together so shared imagery is fetched once and every pixel is only run
+    # through the detector once.
+    # Returns (tile_coords, buildings) for every rectangle. With write_images
+    # False only the JOSM XML files are written, not the images with the
+    # buildings drawn on.
+    def processTiles(self, tiles, write_images=True):
+        tiles_coords = []
 
         for tile in tiles:
 
             min_lon, min_lat, max_lon, max_lat = [float(x) for x in tile]
-            self.processTile(tile_count, min_lat, min_lon, max_lat, max_lon)
+            tiles_coords.append(self.map_generator.coords_to_ltrb(((min_lat, min_lon),(max_lat, max_lon)), left=180, right=-180, top=180, bottom=-180))
+
+        logging.info("Downloading satellite imagery for %i tiles" % len(tiles_coords))
+
+        plan                    = TilePlan(self.map_generator, tiles_coords, self._getPool())
+        plan.prefetch(self.map_generator.get_tile_manager())
+
+        # Every building is clipped to each rectangle it overlaps, as it would be if
+        # the rectangle had been scanned on its own
+        sources_buildings       = {}
+        for source, tiles_buildings in self._detectPlan(plan).items():
+            sources_buildings[source] = [self._clipBuildings(plan.rectangles[tile_index], tile_buildings) for tile_index, tile_buildings in enumerate(tiles_buildings)]
+
+        # Rectangles can overlap, so each building is only recorded once
+        for source, tiles_buildings in sources_buildings.items():
+            self._recordResults(tiles_coords, self._mergeClipped(plan, tiles_buildings), source)
+
+        output = []
+        for tile_index, tile_coords in enumerate(tiles_coords):
+            tile_id             = tile_index + 1
+            ll_p_x, ll_p_y, ur_p_x, ur_p_y, zoom = plan.rectangles[tile_index]
+
+            # Convert back to pixels relative to this tile
+            sources             = {}
+            for source, tiles_buildings in sources_buildings.items():
+                sources[source] = [(p_x - ll_p_x, ur_p_y - p_y, width, height) for building, (p_x, p_y, width, height) in tiles_buildings[tile_index]]
+
+            buildings           = sources.pop(None)
+
+            logging.info("%i buildings after filtering for tile %s" % (len(buildings), tile_id))
+
+            if write_images:
+                tile_image      = self.map_generator.get_tile_image(tile_coords, cache=False)
+            else:
+                tile_image      = None
+                self.map_generator.set_tile_coords(tile_coords)
+
+            index               = self._getMappedIndex(tile_id, tile_coords, (self.map_generator.image_width, self.map_generator.image_height))
+            buildings, tags     = self._conflateBuildings(tile_id, index, buildings)
+            self._writeOutput(tile_id, tile_coords, tile_image, buildings, tags)
+            for train_id, cascade_buildings in sorted(sources.items()):
+                self._writeCascadeOutput(tile_coords, train_id, *self._conflateBuildings(tile_id, index, cascade_buildings))
+
+            output.append((tile_coords, buildings))
+
+        return output
+
+    # Runs the detector over each window of the plan and returns, for every
+    # source (see _detectImage) and rectangle, the (p_x, p_y, width, height)
+    # buildings that overlap it (unclipped, see _clipBuildings).
+    # p_x, p_y are the pixel coordinates of the building's top left corner.
+    def _detectPlan(self, plan):
+        if self.INCREMENTAL == True:
+            return self._detectPlanTiles(plan)
+
+        sources_buildings = {}
+        windows         = plan.windows(halo=max(self.MAX_WIDTH, self.MAX_HEIGHT))
+
+        for window_id, (core, extended, zoom) in enumerate(windows):
+
+            logging.info("Running detector for window %i of %i" % (window_id + 1, len(windows)))
+
+            self.map_generator.set_pixel_bounds(extended[0], extended[1], extended[2], extended[3], zoom)
+            window_image        = self.map_generator.generate_static_map()
+
+            for source, buildings in self._detectImage(window_image).items():
+                tiles_buildings = sources_buildings.setdefault(source, [[] for rectangle in plan.rectangles])
+
+                for left, top, width, height in buildings:
+                    p_x         = extended[0] + left
+                    p_y         = extended[3] - top
+                    overlapping = plan.rectangles_overlapping((p_x, p_y - height, p_x + width, p_y))
+                    if not overlapping:
+                        continue
+
+                    # Buildings found in the halo belong to the neighbouring window. The
+                    # building can be centred outside every rectangle, so the centre of
+                    # its part in the first rectangle it overlaps decides.
+                    rectangle   = plan.rectangles[overlapping[0]]
+                    centre_x    = (max(p_x, rectangle[0]) + min(p_x + width, rectangle[2])) / 2.0
+                    centre_y    = (max(p_y - height, rectangle[1]) + min(p_y, rectangle[3])) / 2.0
+                    if not (core[0] <= centre_x < core[2] and core[1] <= centre_y < core[3]):
+                        continue
+
+                    # Windows span overlapping rectangles, so a building can be in several
+                    for tile_index in overlapping:
+                        tiles_buildings[tile_index].append((p_x, p_y, width, height))
+
+        if not sources_buildings:
+            sources_buildings[None] = [[] for rectangle in plan.rectangles]
+        return sources_buildings
+
+    # The same as _detectPlan, but the work is split along the imagery tile grid.
+    # Every tile that a building overlapping a rectangle can be centred in has
+    # its buildings (those whose centre lies in it) stored under the hashes of
+    # the tiles within the halo, and the detector only runs over the tiles that
+    # have nothing stored.
+    def _detectPlanTiles(self, plan):
+        halo            = max(self.MAX_WIDTH, self.MAX_HEIGHT)
+        tile_size       = plan.TILE_SIZE
+        ring            = int(math.ceil(halo / float(tile_size)))
+        tile_manager    = self.map_generator.get_tile_manager()
+        sources         = [None] + list(self.train_ids or [])
+
+        # A building crossing a rectangle's edge can be centred up to half its size outside it
+        cells           = plan.grid_cells(margin=halo // 2)
+        neighbourhood   = [(dx, dy) for dy in range(-ring, ring + 1) for dx in range(-ring, ring + 1)]
+        tiles           = sorted(set((x + dx, y + dy, zoom) for x, y, zoom in cells for dx, dy in neighbourhood))
+
+        plan.prefetch(tile_manager, tiles=tiles)
+        hashes          = plan.tile_hashes(tile_manager, tiles)
+
+        cascade_hash    = self._getEnsemble().cascade_hash if self.train_ids is not None else self._getEngine().cascade_hash
+        settings        = self._getTileSettings(halo, tile_size)
+        keys            = {}
+        for x, y, zoom in cells:
+            keys[(x, y, zoom)] = self.tile_results.key([hashes[(x + dx, y + dy, zoom)] for dx, dy in neighbourhood], cascade_hash, settings)
+
+        cells_sources   = dict(zip(cells, self.tile_results.get_many([keys[cell] for cell in cells], plan.pool)))
+        changed         = [cell for cell in cells if cells_sources[cell] is None]
+
+        logging.info("Reusing stored detections for %i of %i imagery tiles" % (len(cells) - len(changed), len(cells)))
+
+        windows         = plan.cell_windows(changed, halo)
+        if windows:
+            # Stitching can also ask for the tiles just past the halo
+            plan.prefetch(tile_manager, tiles=sorted(set(tile for core, extended, zoom in windows for tile in plan.stitch_tiles(extended, zoom))))
+
+        for window_id, (core, extended, zoom) in enumerate(windows):
+
+            logging.info("Running detector for window %i of %i" % (window_id + 1, len(windows)))
+
+            self.map_generator.set_pixel_bounds(extended[0], extended[1], extended[2], extended[3], zoom)
+            window_image        = self.map_generator.generate_static_map()
+
+            window_cells        = {}
+            for x in range(core[0] // tile_size, core[2] // tile_size):
+                for y in range(core[1] // tile_size, core[3] // tile_size):
+                    window_cells[(x, y, zoom)] = dict((source, []) for source in sources)
+
+            for source, buildings in self._detectImage(window_image).items():
+                for left, top, width, height in buildings:
+                    p_x         = extended[0] + left
+                    p_y         = extended[3] - top
+                    cell        = (int((p_x + width / 2.0) // tile_size), int((p_y - height / 2.0) // tile_size), zoom)
+
+                    # Buildings found in the halo belong to the neighbouring tiles
+                    if cell in window_cells:
+                        window_cells[cell][source].append((p_x - cell[0] * tile_size, p_y - cell[1] * tile_size, width, height))
+
+            self.tile_results.put_many([(keys[cell], cell_sources) for cell, cell_sources in window_cells.items()])
+            cells_sources.update(window_cells)
+
+        # Convert back to pixels and hand each building to every rectangle it overlaps
+        sources_buildings = dict((source, [[] for rectangle in plan.rectangles]) for source in sources)
+        for x, y, zoom in cells:
+            for source, buildings in cells_sources[(x, y, zoom)].items():
+                for left, top, width, height in buildings:
+                    p_x         = x * tile_size + left
+                    p_y         = y * tile_size + top
+                    for tile_index in plan.rectangles_overlapping((p_x, p_y - height, p_x + width, p_y)):
+                        sources_buildings[source][tile_index].append((p_x, p_y, width, height))
+
+        return sources_buildings
+
+    # Clips (p_x, p_y, width, height) buildings (p_x, p_y being the top left
+    # corner) to the (ll_p_x, ll_p_y, ur_p_x, ur_p_y, zoom) rectangle. Buildings
+    # left smaller than the minimum size are dropped, as a scan of the
+    # rectangle on its own wouldn't return them.
+    # Returns (building, clipped building) pairs.
+    def _clipBuildings(self, rectangle, buildings):
+        ll_p_x, ll_p_y, ur_p_x, ur_p_y, zoom = rectangle
+
+        clipped_buildings = []
+        for p_x, p_y, width, height in buildings:
+            left    = max(p_x, ll_p_x)
+            right   = min(p_x + width, ur_p_x)
+            top     = min(p_y, ur_p_y)
+            bottom  = max(p_y - height, ll_p_y)
+            if right - left >= self.MIN_WIDTH and top - bottom >= self.MIN_HEIGHT:
+                clipped_buildings.append(((p_x, p_y, width, height), (left, top, right - left, top - bottom)))
+
+        return clipped_buildings
+
+    # Combines the (building, clipped building) pairs of every rectangle into one
+    # (p_x, p_y, width, height, zoom) box per building. A building in several
+    # rectangles is identified by its unclipped box, and recorded as the extent
+    # of its clipped boxes.
+    def _mergeClipped(self, plan, tiles_buildings):
+        extents = {}
+        for tile_index, tile_buildings in enumerate(tiles_buildings):
+            zoom = plan.rectangles[tile_index][4]
+            for building, (p_x, p_y, width, height) in tile_buildings:
+                extent = (p_x, p_y - height, p_x + width, p_y)
+                if (building, zoom) in extents:
+                    previous = extents[(building, zoom)]
+                    extent = (min(previous[0], extent[0]), min(previous[1], extent[1]), max(previous[2], extent[2]), max(previous[3], extent[3]))
+                extents[(building, zoom)] = extent
+
+        return sorted((left, top, right - left, top - bottom, zoom) for (building, zoom), (left, bottom, right, top) in extents.items())
+
+    # Everything other than the imagery and the cascade that changes the buildings stored for a tile
+    def _getTileSettings(self, halo, tile_size):
+        return (
+            float(self.SCALE_FACTOR),
+            self.MIN_NEIGHBORS,
+            (self.MIN_WIDTH, self.MIN_HEIGHT),
+            (self.MAX_WIDTH, self.MAX_HEIGHT),
+            self.BOUND_PYRAMID == True,
+            self.LINE_FILTER == True and (self.LINE_THRESHOLD, self.MIN_LINE_LENGTH),
+            self.SKIP_UNIFORM == True and self.UNIFORM_STDDEV,
+            self.train_ids and list(self.train_ids),
+            self.train_ids and self.MIN_VOTES,
+            halo,
+            tile_size
+            )
+
+    # Runs the cascade (or every cascade) over the image and filters the results.
+    # Returns {source: buildings}. The None source is the normal output and, with
+    # several train IDs, there is also one source per train ID.
+    def _detectImage(self, image):
+        if self.train_ids is None:
+            return {None: self._filterBuildings(image, self._findBuildings(image))}
 
-            tile_count = tile_count + 1
+        ensemble    = self._getEnsemble()
+        sources     = {}
+        for train_id, buildings in zip(self.train_ids, ensemble.detect(image)):
+            sources[train_id] = self._filterBuildings(image, buildings)
+
+        buildings, votes = ensemble.fuse([sources[train_id] for train_id in self.train_ids], self.MIN_VOTES)
+        sources[None] = [tuple(building) for building in buildings]
+        return sources
 
     def processTile(self, tile_id, min_lat, min_lon, max_lat, max_lon):
 
@@ -55,45 +461,135 @@ class Detect:
 
         logging.info("Running detector for tile %s" % tile_id)
 
-        buildings               = self._findBuildings(tile_image)
+        sources                 = self._detectImage(tile_image)
+        buildings               = sources.pop(None)
 
-        logging.info("Detected %i buildings for tile %s" % (len(buildings), tile_id))
+        logging.info("%i buildings after filtering for tile %s" % (len(buildings), tile_id))
 
-        buildings                = self._filterBuildings(tile_image, buildings)
+        generator = self.map_generator
+        index = self._getMappedIndex(tile_id, tile_coords, tile_image.size)
+        self._recordResults([tile_coords], [(generator.ll_p_x + left, generator.ur_p_y - top, width, height, generator.zoom) for left, top, width, height in buildings])
+        for train_id, cascade_buildings in sorted(sources.items()):
+            self._recordResults([tile_coords], [(generator.ll_p_x + left, generator.ur_p_y - top, width, height, generator.zoom) for left, top, width, height in cascade_buildings], train_id)
+            self._writeCascadeOutput(tile_coords, train_id, *self._conflateBuildings(tile_id, index, cascade_buildings))
 
-        logging.info("%i buildings after filtering for tile %s" % (len(buildings), tile_id))
+        self._writeOutput(tile_id, tile_coords, tile_image, *self._conflateBuildings(tile_id, index, buildings))
 
-        output_data              = self._getOutputData(tile_coords, buildings)
+    # Writes the JOSM XML file and the satellite image with the buildings drawn on
+    # (unless tile_image is None). Expects the map generator to be set to tile_coords.
+    def _writeOutput(self, tile_id, tile_coords, tile_image, buildings, tags=None):
 
-        # Draw detected buildings onto output satellite image
-        draw                    = ImageDraw.Draw(tile_image)
-        for detection in buildings:
-            draw.rectangle([detection[0], detection[1], detection[0]+detection[2], detection[1]+detection[3]], None, (0, 255, 0))
+        output_data              = self._getOutputData(tile_coords, buildings, tags)
 
         logging.info("Writing data to output folder for tile %s" % tile_id)
 
         # Generate the output filename (the search GPS coords concated together)
-        filename        = ','.join(str(item) for item in tile_coords)
+        filename        = self._getOutputName(tile_coords)
 
         # Output JSOM XML file
         self.storagemanager.put("detector_output", "%s.xml" % filename, output_data)
 
-        # Output satellite image
-        img_filename    = self.storagemanager.build_filename("detector_output", "%s.png" % filename)
-        tile_image.save(img_filename, "PNG")
+        if tile_image is None:
+            return
 
-    # Runs the generated cascade against the satellite image
-    def _findBuildings(self, image): 
-        open_cv_image  = numpy.array(image) 
+        # Draw detected buildings onto output satellite image (flagged ones in red)
+        draw                    = ImageDraw.Draw(tile_image)
+        for building_index, detection in enumerate(buildings):
+            colour = (255, 0, 0) if tags is not None and tags[building_index] else (0, 255, 0)
+            draw.rectangle([detection[0], detection[1], detection[0]+detection[2], detection[1]+detection[3]], None, colour)
 
-        # Load the previously generated cascade
-        raw_cascade = self.storagemanager.build_filename("classifier_output", "cascade.xml")
-        cascade     = cv2.CascadeClassifier(raw_cascade)
+        # Output satellite image
+        img_bytes       = cStringIO.StringIO()
+        tile_image.save(img_bytes, "PNG")
+        self.storagemanager.put("detector_output", "%s.png" % filename, img_bytes.getvalue(), overwrite=True)
+
+    # Writes the JOSM XML file of one cascade's buildings when several are run together.
+    # Expects the map generator to be set to tile_coords.
+    def _writeCascadeOutput(self, tile_coords, train_id, buildings, tags=None):
+        output_data     = self._getOutputData(tile_coords, buildings, tags)
+        self.storagemanager.put("detector_output", "%s.%s.xml" % (self._getOutputName(tile_coords), train_id), output_data)
+
+    def _getOutputName(self, tile_coords):
+        return ','.join(str(item) for item in tile_coords)
+
+    # Adds a run and its (p_x, p_y, width, height, zoom) buildings to the results database.
+    # p_x, p_y are the pixel coordinates of the building's top left corner.
+    # source is the train ID of one cascade when several are run together.
+    def _recordResults(self, tiles_coords, buildings, source=None):
+        if self.RECORD_RESULTS == False:
+            return
 
-        return cascade.detectMultiScale(
-            open_cv_image, 
-            scaleFactor=self.SCALE_FACTOR, 
-            minNeighbors=self.MIN_NEIGHBORS
+        if self.results is None:
+            self.results = ResultStore()
+
+        settings = {
+            'scale_factor'  : self.SCALE_FACTOR,
+            'min_neighbors' : self.MIN_NEIGHBORS,
+            'min_size'      : [self.MIN_WIDTH, self.MIN_HEIGHT],
+            'max_size'      : [self.MAX_WIDTH, self.MAX_HEIGHT],
+            'line_filter'   : self.LINE_FILTER,
+            'tiles_coords'  : tiles_coords
+            }
+        if source is not None:
+            train_id, cascade_hash = source, self._getEngine(source).cascade_hash
+        elif self.train_ids is not None:
+            train_id, cascade_hash = self.storagemanager.output_id, self._getEnsemble().cascade_hash
+            settings['train_ids'] = self.train_ids
+            settings['min_votes'] = self.MIN_VOTES
+        else:
+            train_id, cascade_hash = self.storagemanager.output_id, self._getEngine().cascade_hash
+
+        run_id = self.results.start_run(train_id, cascade_hash, settings)
+
+        mercator = self.map_generator.mercator
+        boxes = []
+        for p_x, p_y, width, height, zoom in buildings:
+            min_lat, min_lon = mercator.MetersToLatLon(*mercator.PixelsToMeters(p_x, p_y - height, zoom))
+            max_lat, max_lon = mercator.MetersToLatLon(*mercator.PixelsToMeters(p_x + width, p_y, zoom))
+            boxes.append((min_lon, min_lat, max_lon, max_lat))
+        self.results.add_detections(run_id, boxes)
+
+        logging.info("Recorded %i buildings as run %i in %s" % (len(boxes), run_id, self.results.filename))
+
+    # Runs the generated cascade against the satellite image
+    def _findBuildings(self, image):
+        return self._getEngine().detect(image)
+
+    # Loads the cascades of every train ID (once per Detect instance)
+    def _getPool(self):
+        if self._pool is None:
+            self._pool = ThreadPool(self.THREADS)
+        return self._pool
+
+    def _getEnsemble(self):
+        if self.ensemble is None:
+            self.ensemble = EnsembleEngine([self._getEngine(train_id) for train_id in self.train_ids])
+        return self.ensemble
+
+    # Loads the previously generated cascade (once per Detect instance).
+    # train_id loads the cascade of another training set.
+    def _getEngine(self, train_id=None):
+        if train_id is not None:
+            if train_id not in self.engines:
+                self.engines[train_id] = self._loadEngine(train_id)
+            return self.engines[train_id]
+
+        if self.engine is None:
+            self.engine = self._loadEngine(None)
+        return self.engine
+
+    def _loadEngine(self, train_id):
+        raw_cascade = self.storagemanager.get_local_filename("classifier_output", "cascade.xml", train_id)
+        return CascadeEngine(
+            raw_cascade,
+            self.SCALE_FACTOR,
+            self.MIN_NEIGHBORS,
+            (self.MIN_WIDTH, self.MIN_HEIGHT),
+            (self.MAX_WIDTH, self.MAX_HEIGHT),
+            bound_pyramid=self.BOUND_PYRAMID == True,
+            skip_uniform=self.SKIP_UNIFORM,
+            uniform_stddev=self.UNIFORM_STDDEV,
+            cache=CandidateCache(self.storagemanager) if self.CACHE_CANDIDATES == True else None
             )
 
     def _filterBuildings(self, image, buildings):
@@ -102,9 +598,15 @@ class Detect:
             filtered_building = self._filterBuilding(image, building_coords)
             if filtered_building is not None:
                 filtered_buildings.append(filtered_building)
+
+        # The line filter checks all the detections in the image in one pass
+        if self.LINE_FILTER == True and len(filtered_buildings) > 0:
+            has_lines = self._getLineFilter().filter(image, filtered_buildings)
+            filtered_buildings = [building_coords for building_coords, keep in zip(filtered_buildings, has_lines) if keep]
+
         return filtered_buildings
 
-    # Remove large and small detections and optionally runs the line filter
+    # Remove large and small detections
     def _filterBuilding(self, image, building_coords):
         # Skip really big squares (usually a false positive)
         left, top, width, height = building_coords
@@ -114,16 +616,47 @@ class Detect:
         if width < self.MIN_WIDTH or height < self.MIN_HEIGHT:
             return
 
-        if self.LINE_FILTER == True:
-            building_image  = image.crop((left, top, left+width, top+height)).copy()
+        return building_coords
 
-            if self._isLinesInImage(building_image) == False:
-                return
+    # Indexes the pixel boxes of the buildings OSM already has in the tile (None if CONFLATE is off).
+    # Expects the map generator to be set to tile_coords.
+    def _getMappedIndex(self, tile_id, tile_coords, image_size):
+        if self.CONFLATE is None:
+            return None
 
-        return building_coords
+        logging.info("Downloading OSM building data for tile %s" % tile_id)
+
+        left, right, top, bottom = tile_coords
+        building_data   = self.osmmanager.getBuildingData(left, right, top, bottom)
+        return BoxIndex(building_data.pixel_bboxes(self.map_generator, image_size))
+
+    # Drops or flags the buildings that overlap a mapped building in the index.
+    # Returns (buildings, tags) where tags is None or the extra tags of each building.
+    def _conflateBuildings(self, tile_id, index, buildings):
+        if index is None:
+            return buildings, None
+
+        mapped = numpy.zeros(len(buildings), dtype=bool)
+        if len(index) > 0:
+            for building_index, (left, top, width, height) in enumerate(buildings):
+                box     = (left, top, left + width, top + height)
+                nearby  = index.query(box)
+                if len(nearby) > 0 and index.iou(box, nearby).max() >= self.CONFLATE_IOU:
+                    mapped[building_index] = True
+
+        logging.info("%i of %i buildings for tile %s are already in OSM" % (mapped.sum(), len(buildings), tile_id))
+
+        if self.CONFLATE == 'flag':
+            return buildings, [{'fixme': 'overlaps a building already in OSM'} if is_mapped else {} for is_mapped in mapped]
+        return [building for building, is_mapped in zip(buildings, mapped) if not is_mapped], None
+
+    def _getLineFilter(self):
+        if self.line_filter is None or (self.line_filter.line_threshold, self.line_filter.min_line_length) != (self.LINE_THRESHOLD, self.MIN_LINE_LENGTH):
+            self.line_filter = LineFilter(self.LINE_THRESHOLD, self.MIN_LINE_LENGTH)
+        return self.line_filter
 
     # Generates the XML output that can be loaded into JSOM
-    def _getOutputData(self, tile_coords, building_data):
+    def _getOutputData(self, tile_coords, building_data, tags=None):
 
         minlat = tile_coords[1]
         minlon = tile_coords[0]
@@ -139,35 +672,10 @@ class Detect:
 
             output_data.append(nodes)
 
-        output_xml = self.osmmanager.generateOutputXml(minlat, minlon, maxlat, maxlon, output_data)
+        output_xml = self.osmmanager.generateOutputXml(minlat, minlon, maxlat, maxlon, output_data, tags)
 
         return output_xml
 
     # Calculates if a straight line is in a given image
     def _isLinesInImage(self, image):
-        
-        # Convert RGB image to a numpy grayscale
-        open_cv_orig_image = numpy.array(image)
-        open_cv_orig_image = open_cv_orig_image[:, :, ::-1]
-        gray = cv2.cvtColor(open_cv_orig_image, cv2.COLOR_BGR2GRAY)
-
-        # Use two different types of bluring on the image to remove noise
-        gBlur = cv2.GaussianBlur(gray, (3, 3), 0)
-        mBlur = cv2.medianBlur(gBlur, ksize = 7)
-
-        # Use a combination of canny and hough lines to find straight lines in the image
-        th, bw = cv2.threshold(mBlur, 50, 150, cv2.THRESH_BINARY | cv2.THRESH_OTSU)
-
-        # Start with the least sensitive detector and keep going until lines are found
-        for aperture in range(3, 8, 2):
-            canny = cv2.Canny(mBlur, th/2, th, apertureSize = aperture, L2gradient=True)
-            lines = cv2.HoughLinesP(canny, rho = 1, theta = math.pi / 180, threshold = self.LINE_THRESHOLD, minLineLength = self.MIN_LINE_LENGTH, maxLineGap = 0)
-
-            # Keep going if we find < 2 lines
-            if lines is not None and len(lines[0]) > 0:
-                break
-
-        if lines is not None and len(lines[0]) > 0:
-            return True
-
-        return False
\ No newline at end of file
+        return bool(self._getLineFilter().filter(image, [(0, 0, image.size[0], image.size[1])])[0])
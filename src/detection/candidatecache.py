@@ -0,0 +1,93 @@
+import hashlib
+import cStringIO
+import cv2
+import numpy
+
+# The raw, ungrouped output of a cascade run over one mosaic.
+#
+# Every window the cascade accepted is kept along with its final stage weight
+# and the scan region it came from. Grouping these with a given MIN_NEIGHBORS
+# gives exactly what detectMultiScale(minNeighbors=MIN_NEIGHBORS) returns, so
+# the sensitivity settings can be changed without running the cascade again.
+class Candidates(object):
+
+    # Same value detectMultiScale uses when grouping
+    GROUP_EPS = 0.2
+
+    def __init__(self, rects, level_weights, regions, min_size, max_size):
+        self.rects          = numpy.asarray(rects, dtype=numpy.int32).reshape(-1, 4)
+        self.level_weights  = numpy.asarray(level_weights, dtype=numpy.float64).ravel()
+        self.regions        = numpy.asarray(regions, dtype=numpy.int32).ravel()
+        self.min_size       = tuple(min_size)
+        self.max_size       = tuple(max_size)
+
+    def __len__(self):
+        return len(self.rects)
+
+    # True if these candidates were generated with a pyramid that includes every
+    # window size between min_size and max_size. A max_size of 0 is unbounded.
+    def covers(self, min_size, max_size):
+        return (self.min_size[0] <= min_size[0] and self.min_size[1] <= min_size[1] and
+                all(own == 0 or (size != 0 and own >= size) for own, size in zip(self.max_size, max_size)))
+
+    # Groups the candidates the same way detectMultiScale does. Each scan region
+    # was grouped separately by the cascade so that is repeated here.
+    # Returns (detections, neighbor counts).
+    def group(self, min_neighbors):
+        detections  = []
+        neighbors   = []
+
+        for region in numpy.unique(self.regions):
+            rects = self.rects[self.regions == region]
+
+            if min_neighbors <= 0:
+                grouped, weights = rects, numpy.ones(len(rects))
+            else:
+                grouped, weights = cv2.groupRectangles([[int(value) for value in rect] for rect in rects], min_neighbors, self.GROUP_EPS)
+
+            if len(grouped):
+                detections.append(numpy.asarray(grouped, dtype=numpy.int32).reshape(-1, 4))
+                neighbors.append(numpy.asarray(weights, dtype=numpy.int32).ravel())
+
+        if not detections:
+            return numpy.empty((0, 4), dtype=numpy.int32), numpy.empty(0, dtype=numpy.int32)
+        return numpy.concatenate(detections), numpy.concatenate(neighbors)
+
+    def serialize(self):
+        output = cStringIO.StringIO()
+        numpy.savez(output,
+            rects=self.rects,
+            level_weights=self.level_weights,
+            regions=self.regions,
+            min_size=numpy.asarray(self.min_size),
+            max_size=numpy.asarray(self.max_size)
+            )
+        return output.getvalue()
+
+    @classmethod
+    def deserialize(cls, data):
+        arrays = numpy.load(cStringIO.StringIO(data))
+        return cls(arrays['rects'], arrays['level_weights'], arrays['regions'], arrays['min_size'], arrays['max_size'])
+
+
+# Stores Candidates through the storage manager, keyed by the imagery, the
+# cascade and the settings that change which windows the cascade evaluates
+class CandidateCache(object):
+
+    def __init__(self, storagemanager):
+        self.storagemanager = storagemanager
+
+    @staticmethod
+    def key(gray, cascade_hash, scale_factor, scan_settings):
+        image_hash = hashlib.md5(numpy.ascontiguousarray(gray)).hexdigest()
+        settings = hashlib.md5(repr((gray.shape, float(scale_factor), scan_settings))).hexdigest()
+        return "%s_%s_%s" % (image_hash, cascade_hash, settings[:12])
+
+    def get(self, key):
+        data = self.storagemanager.get("detector_cache", "%s.npz" % key)
+        if data is None:
+            return None
+        return Candidates.deserialize(data)
+
+    def put(self, key, candidates):
+        self.storagemanager.put("detector_cache", "%s.npz" % key, candidates.serialize(), overwrite=True)
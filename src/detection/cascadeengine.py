@@ -0,0 +1,212 @@
+import cv2
+import numpy
+import hashlib
+from detection.candidatecache import Candidates
+
+# Runs a trained cascade over a mosaic.
+#
+# The mosaic is converted to grayscale once, the cascade's image pyramid can
+# be bounded by the detection size limits, and areas of near uniform colour
+# (water, blank or missing imagery) can be skipped before the cascade runs.
+# If a CandidateCache is given, the raw cascade output for each mosaic is
+# cached and later runs only repeat the grouping.
+class CascadeEngine(object):
+
+    # Candidates of similar size are grouped into one detection, so the pyramid
+    # is bounded a little outside the size limits. This keeps most detections at
+    # the limits, but candidates outside the margin no longer take part in the
+    # grouping, so the results can still differ from an unbounded scan.
+    SIZE_MARGIN         = 1.25
+
+    # If the non-uniform regions cover more than this fraction of the image
+    # it's cheaper to scan the whole image in one go
+    FULL_SCAN_COVERAGE  = 0.75
+
+    def __init__(self, cascade_filename, scale_factor, min_neighbors, min_size, max_size, bound_pyramid=True, skip_uniform=False, uniform_stddev=4, cache=None):
+        self.cascade        = cv2.CascadeClassifier(cascade_filename)
+        self.cascade_hash   = self._hashFile(cascade_filename)
+        self.cache          = cache
+        self.scale_factor   = scale_factor
+        self.min_neighbors  = min_neighbors
+        self.min_size       = min_size
+        self.max_size       = max_size
+        self.bound_pyramid  = bound_pyramid
+        self.skip_uniform   = skip_uniform
+        self.uniform_stddev = uniform_stddev
+
+    # Returns an (n, 4) array of left, top, width, height detections.
+    # regions can be passed in when they are shared with other cascades (see EnsembleEngine)
+    def detect(self, image, regions=None):
+        detections, neighbors = self.detectWithNeighbors(image, regions)
+        return detections
+
+    # Returns the detections and the number of raw candidates grouped into each one
+    def detectWithNeighbors(self, image, regions=None):
+        return self.rawCandidates(image, regions).group(self.min_neighbors)
+
+    # Returns the ungrouped Candidates for an image, from the cache if possible
+    def rawCandidates(self, image, regions=None):
+        gray                = self.prepare(image)
+        min_size, max_size  = self.pyramidSizes()
+
+        if self.cache is None:
+            return self.candidates(gray, min_size, max_size, regions)
+
+        key         = self.cache.key(gray, self.cascade_hash, self.scale_factor, (self.skip_uniform, self.uniform_stddev, self.FULL_SCAN_COVERAGE))
+        candidates  = self.cache.get(key)
+        if candidates is not None and candidates.covers(min_size, max_size):
+            return candidates
+
+        # Widen the pyramid to include anything cached before so narrowing the size limits later is still a cache hit
+        if candidates is not None:
+            min_size = tuple(min(a, b) for a, b in zip(min_size, candidates.min_size))
+            max_size = tuple(0 if a == 0 or b == 0 else max(a, b) for a, b in zip(max_size, candidates.max_size))
+            regions  = None
+
+        candidates  = self.candidates(gray, min_size, max_size, regions)
+        self.cache.put(key, candidates)
+        return candidates
+
+    # Runs the cascade over every region of a grayscale image without grouping
+    def candidates(self, gray, min_size=None, max_size=None, scan_regions=None):
+        if min_size is None or max_size is None:
+            min_size, max_size = self.pyramidSizes()
+        if scan_regions is None:
+            scan_regions = self.regions(gray, min_size, max_size)
+
+        rects           = []
+        level_weights   = []
+        regions         = []
+        for region, (left, top, right, bottom) in enumerate(scan_regions):
+            found, reject_levels, weights = self._detectRegion(gray[top:bottom, left:right], min_size, max_size)
+            if len(found):
+                rects.append(numpy.asarray(found).reshape(-1, 4) + (left, top, 0, 0))
+                level_weights.append(numpy.ravel(weights))
+                regions.append(numpy.repeat(region, len(found)))
+
+        if not rects:
+            return Candidates(numpy.empty((0, 4)), [], [], min_size, max_size)
+        return Candidates(numpy.concatenate(rects), numpy.concatenate(level_weights), numpy.concatenate(regions), min_size, max_size)
+
+    # Converts a PIL image or RGB array to grayscale.
+    # detectMultiScale converts colour images with BGR2GRAY itself, so the same
+    # conversion is used here to keep the results identical.
+    def prepare(self, image):
+        pixels = numpy.asarray(image)
+        if pixels.ndim == 2:
+            return pixels
+        return cv2.cvtColor(pixels, cv2.COLOR_BGR2GRAY)
+
+    # The (min_size, max_size) passed to detectMultiScale, (0, 0) leaves that end unbounded
+    def pyramidSizes(self):
+        if not self.bound_pyramid:
+            return (0, 0), (0, 0)
+
+        min_size = tuple(int(size / self.SIZE_MARGIN) for size in self.min_size)
+        max_size = tuple(int(size * self.SIZE_MARGIN) for size in self.max_size)
+        return min_size, max_size
+
+    # Returns the (left, top, right, bottom) areas of the image worth scanning
+    def regions(self, gray, min_size=None, max_size=None):
+        if min_size is None or max_size is None:
+            min_size, max_size = self.pyramidSizes()
+
+        height, width = gray.shape
+        if not self.skip_uniform:
+            return [(0, 0, width, height)]
+
+        # Without a bounded pyramid the windows can be as large as the image
+        if not any(max_size):
+            min_size, max_size = self.min_size, (width, height)
+
+        active = self.activeMask(gray, min_size)
+        if not active.any():
+            return []
+
+        # Each active block is padded by the largest detection size so that
+        # any detection touching it is scanned in full
+        block_width, block_height   = self._blockSize(min_size)
+        pad = int(numpy.ceil(float(max(max_size)) / min(block_width, block_height)))
+        kernel = numpy.ones((2 * pad + 1, 2 * pad + 1), dtype=numpy.uint8)
+        active = cv2.dilate(active.astype(numpy.uint8), kernel)
+
+        count, labels, stats, centroids = cv2.connectedComponentsWithStats(active, connectivity=8)
+        boxes = []
+        for x, y, w, h, area in stats[1:]:
+            boxes.append([
+                x * block_width,
+                y * block_height,
+                min(width, (x + w) * block_width),
+                min(height, (y + h) * block_height)
+                ])
+        boxes = self._mergeOverlapping(boxes)
+
+        scanned = sum((right - left) * (bottom - top) for left, top, right, bottom in boxes)
+        if scanned > self.FULL_SCAN_COVERAGE * width * height:
+            return [(0, 0, width, height)]
+
+        return [tuple(box) for box in boxes]
+
+    # Boolean grid of blocks (one block per smallest detection) whose
+    # standard deviation shows there is something in them, from an integral image
+    def activeMask(self, gray, min_size):
+        block_width, block_height = self._blockSize(min_size)
+        height, width = gray.shape
+        rows = (height + block_height - 1) // block_height
+        cols = (width + block_width - 1) // block_width
+
+        sums, sq_sums = cv2.integral2(gray, sdepth=cv2.CV_64F)
+
+        ys = numpy.minimum(numpy.arange(rows + 1) * block_height, height)
+        xs = numpy.minimum(numpy.arange(cols + 1) * block_width, width)
+        area = numpy.outer(numpy.diff(ys), numpy.diff(xs))
+
+        block_sums      = self._blockTotals(sums, ys, xs)
+        block_sq_sums   = self._blockTotals(sq_sums, ys, xs)
+        variance        = block_sq_sums / area - (block_sums / area) ** 2
+
+        return variance > self.uniform_stddev ** 2
+
+    def _blockSize(self, min_size):
+        return max(min_size[0], 1), max(min_size[1], 1)
+
+    def _blockTotals(self, integral, ys, xs):
+        corners = integral[numpy.ix_(ys, xs)]
+        return corners[1:, 1:] - corners[:-1, 1:] - corners[1:, :-1] + corners[:-1, :-1]
+
+    # Merges boxes until none of them overlap, so no pixel is scanned twice
+    def _mergeOverlapping(self, boxes):
+        merged = True
+        while merged:
+            merged = False
+            for i in range(len(boxes)):
+                for j in range(i + 1, len(boxes)):
+                    a, b = boxes[i], boxes[j]
+                    if a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]:
+                        boxes[i] = [min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])]
+                        del boxes[j]
+                        merged = True
+                        break
+                if merged:
+                    break
+        return boxes
+
+    # minNeighbors=0 turns off grouping, outputRejectLevels returns each window's final stage weight
+    def _detectRegion(self, gray, min_size, max_size):
+        return self.cascade.detectMultiScale3(
+            gray,
+            scaleFactor=self.scale_factor,
+            minNeighbors=0,
+            minSize=min_size,
+            maxSize=max_size,
+            outputRejectLevels=True
+            )
+
+    def _hashFile(self, filename):
+        hash_object = hashlib.md5()
+        try:
+            with open(filename, 'rb') as f:
+                hash_object.update(f.read())
+        except IOError:
+            pass
+        return hash_object.hexdigest()
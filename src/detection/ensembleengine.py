@@ -0,0 +1,89 @@
+import hashlib
+import numpy
+from multiprocessing.pool import ThreadPool
+
+# Runs several trained cascades over the same mosaic.
+#
+# The grayscale image and the areas worth scanning are worked out once and
+# shared by every cascade, and the cascades run at the same time (OpenCV
+# releases the GIL while detecting). Every engine must use the same scan
+# settings (scale factor, size limits, uniform area skipping), which is the
+# case when they are all created by one Detect. close() stops the threads.
+class EnsembleEngine(object):
+
+    # Detections from different cascades are the same building if their boxes overlap by at least this much
+    FUSE_IOU = 0.5
+
+    def __init__(self, engines):
+        self.engines        = list(engines)
+        self.cascade_hash   = hashlib.md5(','.join(engine.cascade_hash for engine in self.engines)).hexdigest()
+        self._pool          = None
+
+    # Returns an (n, 4) array of left, top, width, height detections for each engine
+    def detect(self, image):
+        first               = self.engines[0]
+        gray                = first.prepare(image)
+        min_size, max_size  = first.pyramidSizes()
+        regions             = first.regions(gray, min_size, max_size)
+
+        # Started on first use, so an ensemble that is never run has no threads
+        if self._pool is None:
+            self._pool = ThreadPool(len(self.engines))
+        return self._pool.map(lambda engine: engine.detect(gray, regions), self.engines)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    # Merges the detections of every engine into one list. A box is added to the
+    # fused box it overlaps most (by FUSE_IOU) that no box from the same engine
+    # has joined yet, and fused boxes are the mean of their members.
+    # Returns (detections, number of engines that found each one), only keeping
+    # detections found by at least min_votes engines.
+    def fuse(self, detections, min_votes=1):
+        sums    = []
+        votes   = []
+
+        for engine_detections in detections:
+            joined = set()
+            for box in numpy.asarray(engine_detections, dtype=numpy.float64).reshape(-1, 4):
+                best = None
+                if sums:
+                    fused       = numpy.array(sums) / numpy.array(votes, dtype=numpy.float64)[:, None]
+                    overlaps    = self._iou(box, fused)
+                    for index in numpy.argsort(-overlaps):
+                        if overlaps[index] < self.FUSE_IOU:
+                            break
+                        if index not in joined:
+                            best = index
+                            break
+
+                if best is None:
+                    sums.append(box.copy())
+                    votes.append(1)
+                    best = len(sums) - 1
+                else:
+                    sums[best] += box
+                    votes[best] += 1
+                joined.add(best)
+
+        if not sums:
+            return numpy.empty((0, 4), dtype=numpy.int32), numpy.empty(0, dtype=numpy.int32)
+
+        votes   = numpy.array(votes, dtype=numpy.int32)
+        fused   = numpy.round(numpy.array(sums) / votes[:, None]).astype(numpy.int32)
+        keep    = votes >= min_votes
+        return fused[keep], votes[keep]
+
+    # IoU of one left, top, width, height box against an array of them
+    def _iou(self, box, boxes):
+        left    = numpy.maximum(box[0], boxes[:, 0])
+        top     = numpy.maximum(box[1], boxes[:, 1])
+        right   = numpy.minimum(box[0] + box[2], boxes[:, 0] + boxes[:, 2])
+        bottom  = numpy.minimum(box[1] + box[3], boxes[:, 1] + boxes[:, 3])
+
+        intersection = numpy.maximum(right - left, 0) * numpy.maximum(bottom - top, 0)
+        union = box[2] * box[3] + boxes[:, 2] * boxes[:, 3] - intersection
+        return intersection / numpy.maximum(union, 1)
@@ -0,0 +1,77 @@
+import math
+import cv2
+import numpy
+
+# Removes detections that don't contain a strong straight line (on the basis
+# that a building will have at least one).
+#
+# The grayscale, blurred and edge images are computed once per call (i.e. once
+# per mosaic) rather than once per detection. Hough needs at least
+# LINE_THRESHOLD edge pixels in a box to find a line, so boxes with fewer
+# (counted with an integral image of the edge map) are rejected without
+# running Hough at all.
+class LineFilter(object):
+
+    APERTURES = [3, 5, 7]
+
+    def __init__(self, line_threshold, min_line_length):
+        self.line_threshold     = line_threshold
+        self.min_line_length    = min_line_length
+
+    # Returns a boolean array, True for each (left, top, width, height) box that contains a line
+    def filter(self, image, buildings):
+        boxes = numpy.array(buildings, dtype=numpy.int64).reshape(-1, 4)
+        keep = numpy.zeros(len(boxes), dtype=bool)
+        if len(boxes) == 0:
+            return keep
+
+        # The maps belong to this call only, nothing is kept between images
+        blurred, threshold = self._prepare(image)
+
+        # Boxes are clipped to the image so they can index the integral images
+        height, width = blurred.shape
+        boxes[:, 2] = numpy.clip(boxes[:, 0] + boxes[:, 2], 0, width)
+        boxes[:, 3] = numpy.clip(boxes[:, 1] + boxes[:, 3], 0, height)
+        boxes[:, 0] = numpy.clip(boxes[:, 0], 0, width)
+        boxes[:, 1] = numpy.clip(boxes[:, 1], 0, height)
+
+        # Start with the least sensitive detector and only retry the boxes with no lines
+        for aperture_index in range(len(self.APERTURES)):
+            remaining = numpy.flatnonzero(~keep)
+            if len(remaining) == 0:
+                break
+
+            edges, integral = self._getEdges(blurred, threshold, aperture_index)
+
+            left, top, right, bottom = boxes[remaining].T
+            edge_pixels = integral[bottom, right] - integral[top, right] - integral[bottom, left] + integral[top, left]
+
+            for index in remaining[edge_pixels >= max(self.line_threshold, 1)]:
+                box_left, box_top, box_right, box_bottom = boxes[index]
+                if self._hasLines(edges[box_top:box_bottom, box_left:box_right]):
+                    keep[index] = True
+
+        return keep
+
+    # Returns the blurred grayscale image and the canny threshold
+    def _prepare(self, image):
+        # Convert RGB image to a numpy grayscale
+        gray = cv2.cvtColor(numpy.asarray(image), cv2.COLOR_RGB2GRAY)
+
+        # Use two different types of bluring on the image to remove noise
+        gBlur = cv2.GaussianBlur(gray, (3, 3), 0)
+        blurred = cv2.medianBlur(gBlur, ksize = 7)
+
+        # Otsu picks the canny thresholds
+        threshold, bw = cv2.threshold(blurred, 50, 150, cv2.THRESH_BINARY | cv2.THRESH_OTSU)
+        return blurred, threshold
+
+    # Returns the edge map of one aperture and the integral image of its edge pixels.
+    # Only called for the apertures that are needed.
+    def _getEdges(self, blurred, threshold, aperture_index):
+        edges = cv2.Canny(blurred, threshold / 2, threshold, apertureSize = self.APERTURES[aperture_index], L2gradient=True)
+        return edges, cv2.integral((edges > 0).astype(numpy.uint8))
+
+    def _hasLines(self, edges):
+        lines = cv2.HoughLinesP(edges, rho = 1, theta = math.pi / 180, threshold = self.line_threshold, minLineLength = self.min_line_length, maxLineGap = 0)
+        return lines is not None and len(lines[0]) > 0
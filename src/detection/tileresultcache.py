@@ -0,0 +1,53 @@
+import json
+import hashlib
+from multiprocessing.pool import ThreadPool
+
+# Stores the filtered detections of one imagery tile, keyed by the content of
+# the tile and the tiles around it (everything the detector saw while finding
+# the tile's buildings), the cascade and the detection settings.
+#
+# Each entry is {source: [(p_x, p_y, width, height), ...]} where p_x, p_y (the
+# building's top left corner) are pixels relative to the tile's bottom left
+# corner, so tiles with the same imagery share an entry wherever they are.
+class TileResultCache(object):
+
+    OBJ_TYPE    = "detector_tiles"
+    THREADS     = 8
+
+    def __init__(self, storagemanager):
+        self.storagemanager = storagemanager
+
+    @staticmethod
+    def key(tile_hashes, cascade_hash, settings):
+        digest = hashlib.md5(repr((list(tile_hashes), settings))).hexdigest()
+        return "%s_%s" % (cascade_hash, digest)
+
+    def get(self, key):
+        data = self.storagemanager.get(self.OBJ_TYPE, "%s.json" % key)
+        if data is None:
+            return None
+
+        sources = {}
+        for source, buildings in json.loads(data):
+            sources[None if source is None else str(source)] = [tuple(building) for building in buildings]
+        return sources
+
+    # Looks up several keys at once (each is a separate object), None for any that aren't stored.
+    # Runs on pool if given, otherwise on a pool started for the call.
+    def get_many(self, keys, pool=None):
+        if pool is not None:
+            return pool.map(self.get, keys)
+
+        pool = ThreadPool(self.THREADS)
+        try:
+            return pool.map(self.get, keys)
+        finally:
+            pool.close()
+            pool.join()
+
+    # Stores a list of (key, sources) pairs
+    def put_many(self, items):
+        self.storagemanager.put_many(self.OBJ_TYPE, [("%s.json" % key, self._serialize(sources)) for key, sources in items], overwrite=True)
+
+    def _serialize(self, sources):
+        return json.dumps([[source, [[int(value) for value in building] for building in buildings]] for source, buildings in sorted(sources.items())])
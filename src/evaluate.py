@@ -0,0 +1,210 @@
+import logging
+import itertools
+import json
+import math
+import time
+import multiprocessing
+import numpy
+from PIL import Image
+from mapping.tilemanager import StaticMapGenerator
+from mapping.osmmanager import OSMManager
+from mapping.spatialindex import BoxIndex
+from mapping.mosaiccache import MosaicCache
+from storage.storagemanager import getStorageManager
+from detect import Detect
+
+# This class measures how well the trained cascade finds buildings that are
+# already in OSM, for a grid of detector settings.
+#
+# Each area is downloaded once (the mosaics and OSM data are the same ones
+# Train and Detect use). The cascade is run once per scale factor and size
+# limit, and the MIN_NEIGHBORS and line filter settings are applied to those
+# candidates, spread over a pool of processes. Precision, recall and seconds
+# per km^2 are reported for every combination.
+class Evaluate:
+
+    # The settings to sweep, every combination is evaluated
+    SCALE_FACTORS   = [1.1, 1.2, 1.5, 2]
+    MIN_NEIGHBORS   = [2, 3, 4, 6]
+    SIZE_LIMITS     = [((50, 50), (200, 200)), ((30, 30), (200, 200))]  # ((MIN_WIDTH, MIN_HEIGHT), (MAX_WIDTH, MAX_HEIGHT))
+    LINE_FILTERS    = [False, True]
+
+    # A detection matches a building if their boxes overlap by at least this much
+    MATCH_IOU       = 0.3
+
+    # The fastest setting meeting both of these is logged as the recommendation
+    TARGET_PRECISION = 0.6
+    TARGET_RECALL    = 0.6
+
+    # Number of worker processes (None = one per CPU)
+    PROCESSES       = None
+
+    def __init__(self, tile_manager=None, zoom=19):
+        self.map_generator  = StaticMapGenerator([zoom], tile_manager=tile_manager)
+        self.osmmanager     = OSMManager()
+        self.storagemanager = getStorageManager()
+
+    def processTiles(self, tiles):
+        areas = []
+        tile_count = 1
+
+        for tile in tiles:
+
+            min_lon, min_lat, max_lon, max_lat = [float(x) for x in tile]
+            areas.append(self.processTile(tile_count, min_lat, min_lon, max_lat, max_lon))
+
+            tile_count = tile_count + 1
+
+        groups = list(itertools.product(self.SCALE_FACTORS, self.SIZE_LIMITS))
+
+        logging.info("Evaluating %i settings over %i areas" % (len(groups) * len(self.MIN_NEIGHBORS) * len(self.LINE_FILTERS), len(areas)))
+
+        # Make sure nothing is mid-write when the workers are forked
+        self.storagemanager.flush()
+
+        pool = multiprocessing.Pool(self.PROCESSES)
+        try:
+            jobs    = [(areas, scale_factor, size_limits, self.MIN_NEIGHBORS, self.LINE_FILTERS, self.MATCH_IOU) for scale_factor, size_limits in groups]
+            results = list(itertools.chain.from_iterable(pool.map(_evaluateGroup, jobs)))
+        finally:
+            pool.close()
+            pool.join()
+
+        self._report(results)
+        return results
+
+    # Downloads (or loads from the cache) the imagery and OSM buildings for one area
+    def processTile(self, tile_id, min_lat, min_lon, max_lat, max_lon):
+
+        logging.info("Loading satellite imagery for tile %s" % tile_id)
+
+        tile_coords             = self.map_generator.coords_to_ltrb(((min_lat, min_lon),(max_lat, max_lon)), left=180, right=-180, top=180, bottom=-180)
+        tile_pixels             = self.map_generator.get_tile_array(tile_coords)
+        tile_image              = Image.fromarray(numpy.asarray(tile_pixels))
+
+        logging.info("Loading OSM building data for tile %s" % tile_id)
+
+        left, top, right, bottom = tile_coords
+        building_data           = self.osmmanager.getBuildingData(left, top, right, bottom)
+        building_coords         = building_data.pixel_bboxes(self.map_generator, tile_image.size)
+
+        # Buildings partly outside the image can still be matched, but only
+        # the ones fully inside count towards recall
+        inside                  = building_data.inside(building_coords, tile_image.size)
+        visible                 = (building_coords[:, 2] > 0) & (building_coords[:, 3] > 0) & (building_coords[:, 0] < tile_image.size[0]) & (building_coords[:, 1] < tile_image.size[1])
+
+        logging.info("Tile %s has %i buildings" % (tile_id, inside.sum()))
+
+        # Workers map the cached mosaic themselves rather than being sent a copy of the pixels
+        return {
+            'tile_id'   : tile_id,
+            'mosaic'    : self.map_generator.mosaic_cache.get_local_filename(self.map_generator.get_tile_mosaic_name(tile_coords)),
+            'buildings' : building_coords[visible],
+            'inside'    : inside[visible],
+            'km2'       : self._areaKm2(tile_image.size, (tile_coords[1] + tile_coords[3]) / 2.0)
+            }
+
+    # Ground area covered by the mosaic
+    def _areaKm2(self, image_size, lat):
+        resolution = self.map_generator.mercator.Resolution(self.map_generator.zoom) * math.cos(math.radians(lat))
+        return image_size[0] * image_size[1] * resolution * resolution / 1e6
+
+    def _report(self, results):
+        results = sorted(results, key=lambda result: result['seconds_per_km2'])
+
+        for result in results:
+            logging.info("scale_factor=%(scale_factor)s min_neighbors=%(min_neighbors)s min_size=%(min_size)s max_size=%(max_size)s line_filter=%(line_filter)s: "
+                "precision %(precision).3f, recall %(recall).3f, %(seconds_per_km2).2f s/km2" % result)
+
+        meets_target = [result for result in results if result['precision'] >= self.TARGET_PRECISION and result['recall'] >= self.TARGET_RECALL]
+        if meets_target:
+            logging.info("Fastest setting meeting precision %s and recall %s: %s" % (self.TARGET_PRECISION, self.TARGET_RECALL, meets_target[0]))
+        else:
+            logging.info("No setting meets precision %s and recall %s" % (self.TARGET_PRECISION, self.TARGET_RECALL))
+
+        filename = self.storagemanager.put("evaluation_output", "evaluation_%s.json" % time.strftime('%Y%m%d_%H%M%S'), json.dumps(results, indent=2), overwrite=True)
+        logging.info("Evaluation results written to %s" % filename)
+
+
+# Runs the cascade once per area for a scale factor and size limit, then
+# evaluates every MIN_NEIGHBORS and line filter setting against the candidates.
+# Module level so it can be sent to a worker process.
+def _evaluateGroup(job):
+    areas, scale_factor, size_limits, min_neighbors_list, line_filters, match_iou = job
+    (min_width, min_height), (max_width, max_height) = size_limits
+
+    detect = Detect()
+    detect.SCALE_FACTOR = scale_factor
+    detect.MIN_WIDTH, detect.MIN_HEIGHT = min_width, min_height
+    detect.MAX_WIDTH, detect.MAX_HEIGHT = max_width, max_height
+    engine = detect._getEngine()
+
+    prepared = []
+    for area in areas:
+        pixels, header = MosaicCache.open(area['mosaic'])
+        start       = time.time()
+        candidates  = engine.candidates(engine.prepare(pixels))
+        prepared.append((area, Image.fromarray(numpy.asarray(pixels)), candidates, time.time() - start))
+
+    results = []
+    for min_neighbors, line_filter in itertools.product(min_neighbors_list, line_filters):
+        detect.MIN_NEIGHBORS    = min_neighbors
+        detect.LINE_FILTER      = line_filter
+
+        totals = {'detections': 0, 'matched': 0, 'buildings': 0, 'found': 0, 'seconds': 0.0, 'km2': 0.0}
+        for area, image, candidates, cascade_seconds in prepared:
+            start       = time.time()
+            buildings, neighbors = candidates.group(min_neighbors)
+            buildings   = detect._filterBuildings(image, buildings)
+            seconds     = cascade_seconds + time.time() - start
+
+            matched, found = _matchBuildings(buildings, area['buildings'], area['inside'], match_iou)
+
+            totals['detections']    += len(buildings)
+            totals['matched']       += matched
+            totals['buildings']     += int(area['inside'].sum())
+            totals['found']         += found
+            totals['seconds']       += seconds
+            totals['km2']           += area['km2']
+
+        results.append({
+            'scale_factor'      : scale_factor,
+            'min_neighbors'     : min_neighbors,
+            'min_size'          : [min_width, min_height],
+            'max_size'          : [max_width, max_height],
+            'line_filter'       : line_filter,
+            'detections'        : totals['detections'],
+            'buildings'         : totals['buildings'],
+            'precision'         : float(totals['matched']) / totals['detections'] if totals['detections'] else 0.0,
+            'recall'            : float(totals['found']) / totals['buildings'] if totals['buildings'] else 0.0,
+            'seconds_per_km2'   : totals['seconds'] / totals['km2'] if totals['km2'] else 0.0
+            })
+
+    return results
+
+# Greedy one to one matching of detections to OSM buildings by IoU.
+# Returns (detections matched to any building, buildings fully inside the image that were found)
+def _matchBuildings(buildings, building_coords, inside, match_iou):
+    index = BoxIndex(building_coords)
+
+    pairs = []
+    for detection_index, (left, top, width, height) in enumerate(buildings):
+        box         = (left, top, left + width, top + height)
+        nearby      = index.query(box)
+        if len(nearby) == 0:
+            continue
+        overlaps    = index.iou(box, nearby)
+        for building_index, overlap in zip(nearby, overlaps):
+            if overlap >= match_iou:
+                pairs.append((overlap, detection_index, building_index))
+
+    used_detections = set()
+    used_buildings  = set()
+    for overlap, detection_index, building_index in sorted(pairs, reverse=True):
+        if detection_index in used_detections or building_index in used_buildings:
+            continue
+        used_detections.add(detection_index)
+        used_buildings.add(building_index)
+
+    found = sum(1 for building_index in used_buildings if inside[building_index])
+    return len(used_detections), found
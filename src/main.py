@@ -2,9 +2,8 @@ import sys
 import logging
 import argparse
 import hashlib
-from train import Train
-from detect import Detect
 from storage.storagemanager import initStorageManager, getStorageManager
+from mapping.osmmanager import OSMManager
 
 # Logging setup start
 logger 	= logging.getLogger('buildingdetector')
@@ -20,33 +19,117 @@ root.addHandler(ch)
 
 def main():
 	parser = argparse.ArgumentParser()
-	parser.add_argument('--coords',		'--coords', 	type=str, 	required=True, nargs = '*', action='append')
-	parser.add_argument('--type',		'--type', 		type=str, 	required=True, choices=["train", "detect"])
-	parser.add_argument('--train_id',	'--train_id', 	type=str, 	required=False)
+	parser.add_argument('--coords',		'--coords', 	type=str, 	required=False, nargs = '*', action='append')
+	parser.add_argument('--type',		'--type', 		type=str, 	required=True, choices=["train", "detect", "evaluate", "export", "serve"])
+	parser.add_argument('--train_id',	'--train_id', 	type=str, 	required=False, nargs='+', help='Several IDs run the cascades of each training set together (detect only)')
+	parser.add_argument('--storage',	'--storage', 	type=str, 	required=False, help='Store data in an S3 compatible bucket, e.g. s3://bucket/prefix')
+	parser.add_argument('--s3_endpoint','--s3_endpoint',type=str, 	required=False, help='Endpoint URL for S3 compatible stores other than AWS')
+	parser.add_argument('--run_id',		'--run_id', 	type=int, 	required=False, help='Only export the detections of this run')
+	parser.add_argument('--format',		'--format', 	type=str, 	required=False, default='osm', choices=["osm", "geojson"], help='Export file format')
+	parser.add_argument('--port',		'--port', 		type=int, 	required=False, default=8080, help='Port the detection service listens on (localhost only)')
+	parser.add_argument('--workers',	'--workers', 	type=int, 	required=False, default=2, help='Number of jobs the detection service runs at once')
+	parser.add_argument('--osm_api',	'--osm_api', 	type=str, 	required=False, help='URL of the OSM API map call to fetch buildings from (default %s)' % OSMManager.API_URL)
+	parser.add_argument('--refresh_osm','--refresh_osm',action='store_true', help='Fetch the OSM data for the coords again instead of using the cache')
+	parser.add_argument('--conflate',	'--conflate', 	type=str, 	required=False, choices=["drop", "flag"], help='Drop or flag detections of buildings that are already in OSM (detect and serve)')
+	parser.add_argument('--zoom',		'--zoom', 		type=int, 	required=False, default=19, help='Zoom level of the imagery to use (train, detect, evaluate and serve)')
+	parser.add_argument('--raster',		'--raster', 	type=str, 	required=False, help='Use a local GeoTIFF (or any GDAL raster) instead of Bing imagery')
 	args = parser.parse_args()
 
+	if args.coords is None and args.type != 'serve':
+		parser.error('--coords is required for --type %s' % args.type)
+
+	if args.train_id is not None and len(args.train_id) > 1 and args.type != 'detect':
+		parser.error('only --type detect accepts several train IDs')
+
 	# The train_id variable is a hash of  min_lat, min_lon, max_lat, max_lon.
 	# It allows different training sets to be run and stored seperately
 	if args.train_id is None:
-		if args.type == 'detect':
+		if args.type in ['detect', 'evaluate', 'serve']:
 			logger.error('train_id must be set to the ID printed out at the training stage')
 			sys.exit()
 		hash_object = hashlib.md5(str(args.coords))
 		train_id = hash_object.hexdigest()
 	else:
-		train_id = args.train_id
+		# Output of several cascades run together is stored under their combined ID
+		train_id = '+'.join(args.train_id)
 
 	logger.info('Using training ID: %s' % train_id)
 
-	initStorageManager(train_id)
+	storage = None
+	if args.storage is not None:
+		from storage.s3storage import S3Storage
+		bucket, _, prefix = args.storage.replace('s3://', '', 1).partition('/')
+		storage = S3Storage(train_id, bucket, prefix, endpoint_url=args.s3_endpoint)
+
+	initStorageManager(train_id, storage)
+
+	if args.osm_api is not None:
+		OSMManager.API_URL = args.osm_api
+
+	if args.refresh_osm:
+		for tile in args.coords or []:
+			OSMManager().invalidateCache(*coordsToBBox(tile))
+
+	if args.conflate is not None:
+		from detect import Detect
+		Detect.CONFLATE = args.conflate
+
+	tile_manager = None
+	if args.raster is not None:
+		from mapping.tilemanager import RasterTileManager
+		tile_manager = RasterTileManager(args.raster)
 
 	# Loop through each GPS coordinate set provided
+	# Train and Detect pull in OpenCV, so only import the one that's needed
 	if args.type == 'train':
-		train = Train()
+		from train import Train
+		train = Train(tile_manager, args.zoom)
 		train.processTiles(args.coords)
 	if args.type == 'detect':
-		detect = Detect()
-		detect.processTiles(args.coords)
+		from detect import Detect
+		detect = Detect(tile_manager, args.train_id if len(args.train_id) > 1 else None, args.zoom)
+		try:
+			detect.processTiles(args.coords)
+		finally:
+			detect.close()
+	if args.type == 'evaluate':
+		from evaluate import Evaluate
+		evaluate = Evaluate(tile_manager, args.zoom)
+		evaluate.processTiles(args.coords)
+	if args.type == 'serve':
+		from service import DetectionService
+		service = DetectionService(tile_manager, workers=args.workers, zoom=args.zoom)
+		service.serve(port=args.port)
+	if args.type == 'export':
+		export(args.coords, args.train_id and train_id, args.run_id, args.format)
+
+	# Wait for any queued writes to reach the disk before exiting
+	getStorageManager().flush()
+
+# Converts one '--coords lat lon lat lon' rectangle to (min_lon, min_lat, max_lon, max_lat)
+def coordsToBBox(tile):
+	lat1, lon1, lat2, lon2 = [float(x) for x in tile]
+	return (min(lon1, lon2), min(lat1, lat2), max(lon1, lon2), max(lat1, lat2))
+
+# Writes the recorded detections in each rectangle to a file, optionally only
+# those of one training ID or run
+def export(tiles, train_id, run_id, format):
+	from storage.resultstore import ResultStore
+	results = ResultStore()
+
+	for tile in tiles:
+		bbox = coordsToBBox(tile)
+
+		for stats in results.stats(bbox, train_id=train_id, run_id=run_id):
+			logger.info('Run %(run_id)s (train_id %(train_id)s, cascade %(cascade_hash)s): %(detections)i buildings' % stats)
+
+		if format == 'geojson':
+			data = results.export_geojson(bbox, train_id=train_id, run_id=run_id)
+		else:
+			data = results.export_osm(bbox, train_id=train_id, run_id=run_id)
+
+		filename = getStorageManager().put("export_output", "%s.%s" % (','.join(str(item) for item in bbox), format), data, overwrite=True)
+		logger.info('Exported to %s' % filename)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,110 @@
+import numpy
+from mapping.geometry import Polygon
+
+# A column oriented collection of building footprints.
+#
+# Rather than one object per building, every vertex lives in a single (n, 2)
+# array of (lon, lat) coordinates. offsets[i]:offsets[i+1] is the slice of that
+# array holding the closed outer ring of building i. This keeps large areas
+# compact in memory and lets bboxes and pixel projections run as array
+# operations instead of vertex by vertex loops.
+class FootprintCollection(object):
+
+    def __init__(self, coords, offsets, ids=None):
+        self.coords     = numpy.asarray(coords, dtype=numpy.float64).reshape(-1, 2)
+        self.offsets    = numpy.asarray(offsets, dtype=numpy.int64)
+        if ids is None:
+            ids = numpy.arange(len(self.offsets) - 1)
+        self.ids        = numpy.asarray(ids, dtype=numpy.int64)
+        self._bboxes    = None
+
+    # Build a collection from a list of rings, each a list of (lon, lat) tuples
+    @classmethod
+    def from_rings(cls, rings, ids=None):
+        offsets = numpy.zeros(len(rings) + 1, dtype=numpy.int64)
+        offsets[1:] = numpy.cumsum([len(ring) for ring in rings])
+
+        coords = numpy.empty((offsets[-1], 2), dtype=numpy.float64)
+        for i, ring in enumerate(rings):
+            coords[offsets[i]:offsets[i + 1]] = ring
+
+        return cls(coords, offsets, ids)
+
+    @classmethod
+    def empty(cls):
+        return cls(numpy.empty((0, 2)), numpy.zeros(1, dtype=numpy.int64))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    # Iterating yields Polygon objects for code that wants one building at a time
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield Polygon(self.ring(i))
+
+    def ring(self, i):
+        return self.coords[self.offsets[i]:self.offsets[i + 1]]
+
+    # (min_lon, min_lat, max_lon, max_lat) for every building
+    @property
+    def bboxes(self):
+        if self._bboxes is None:
+            self._bboxes = self._reduce_bboxes(self.coords)
+        return self._bboxes
+
+    # Projects every vertex into pixel coordinates relative to the map generator's image
+    def project(self, map_generator):
+        return map_generator.x_y_for_lat_long_array(self.coords[:, 1], self.coords[:, 0])
+
+    # Integer (left, top, right, bottom) pixel boxes for every building.
+    # Matches StaticMapGenerator.coords_to_ltrb(coords, top=height, left=width, returnInt=True)
+    def pixel_bboxes(self, map_generator, image_size):
+        if len(self) == 0:
+            return numpy.empty((0, 4), dtype=numpy.int64)
+
+        pixel_x, pixel_y = self.project(map_generator)
+        bboxes = self._reduce_bboxes(numpy.column_stack((pixel_x, pixel_y)))
+
+        ltrb = numpy.empty_like(bboxes)
+        ltrb[:, 0] = numpy.minimum(bboxes[:, 0], image_size[0])
+        ltrb[:, 1] = numpy.minimum(bboxes[:, 1], image_size[1])
+        ltrb[:, 2] = numpy.maximum(bboxes[:, 2], 0)
+        ltrb[:, 3] = numpy.maximum(bboxes[:, 3], 0)
+
+        # astype truncates towards zero, the same as int()
+        return ltrb.astype(numpy.int64)
+
+    # Draws every footprint into one uint8 mask of the image (1 = building) in a
+    # single fillPoly call. margin grows each footprint by that many pixels.
+    def rasterize(self, map_generator, image_size, margin=0):
+        import cv2
+
+        mask = numpy.zeros((image_size[1], image_size[0]), dtype=numpy.uint8)
+        if len(self) == 0:
+            return mask
+
+        pixel_x, pixel_y = self.project(map_generator)
+        points = numpy.round(numpy.column_stack((pixel_x, pixel_y))).astype(numpy.int32)
+        cv2.fillPoly(mask, numpy.split(points, self.offsets[1:-1]), 1)
+
+        if margin > 0:
+            mask = cv2.dilate(mask, numpy.ones((2 * margin + 1, 2 * margin + 1), dtype=numpy.uint8))
+
+        return mask
+
+    # Mask of the pixel boxes that lie entirely inside the image
+    @staticmethod
+    def inside(ltrb, image_size):
+        return (ltrb[:, 0] >= 0) & (ltrb[:, 1] >= 0) & (ltrb[:, 2] <= image_size[0]) & (ltrb[:, 3] <= image_size[1])
+
+    def _reduce_bboxes(self, coords):
+        if len(self) == 0:
+            return numpy.empty((0, 4), dtype=numpy.float64)
+
+        starts = self.offsets[:-1]
+        return numpy.column_stack((
+            numpy.minimum.reduceat(coords[:, 0], starts),
+            numpy.minimum.reduceat(coords[:, 1], starts),
+            numpy.maximum.reduceat(coords[:, 0], starts),
+            numpy.maximum.reduceat(coords[:, 1], starts)
+            ))
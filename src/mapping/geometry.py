@@ -0,0 +1,92 @@
+# Minimal geometry types used by the map and OSM code.
+#
+# These replace the GEOS backed Django geometries. Only the parts of that API
+# the project actually uses are provided (.coords and .extent), and all
+# coordinates are (x, y) i.e. (lon, lat) tuples.
+
+class BBox(object):
+    __slots__ = ('min_x', 'min_y', 'max_x', 'max_y')
+
+    def __init__(self, min_x, min_y, max_x, max_y):
+        self.min_x = min_x
+        self.min_y = min_y
+        self.max_x = max_x
+        self.max_y = max_y
+
+    @classmethod
+    def from_points(cls, points):
+        xs = [point[0] for point in points]
+        ys = [point[1] for point in points]
+        return cls(min(xs), min(ys), max(xs), max(ys))
+
+    @property
+    def extent(self):
+        return (self.min_x, self.min_y, self.max_x, self.max_y)
+
+    def union(self, other):
+        return BBox(min(self.min_x, other.min_x), min(self.min_y, other.min_y),
+                    max(self.max_x, other.max_x), max(self.max_y, other.max_y))
+
+    def __repr__(self):
+        return 'BBox(%s, %s, %s, %s)' % self.extent
+
+
+class LineString(object):
+    __slots__ = ('_coords', '_extent')
+
+    def __init__(self, coords):
+        self._coords = tuple(tuple(point) for point in coords)
+        self._extent = None
+
+    @property
+    def coords(self):
+        return self._coords
+
+    @property
+    def extent(self):
+        if self._extent is None:
+            self._extent = BBox.from_points(self._coords).extent
+        return self._extent
+
+
+class MultiLineString(object):
+    __slots__ = ('lines', '_extent')
+
+    def __init__(self, lines):
+        self.lines = list(lines)
+        self._extent = None
+
+    @property
+    def coords(self):
+        return tuple(line.coords for line in self.lines)
+
+    @property
+    def extent(self):
+        if self._extent is None:
+            bbox = BBox(*self.lines[0].extent)
+            for line in self.lines[1:]:
+                bbox = bbox.union(BBox(*line.extent))
+            self._extent = bbox.extent
+        return self._extent
+
+
+class Polygon(object):
+    __slots__ = ('shell', '_extent')
+
+    # The shell is a closed ring of (x, y) points
+    def __init__(self, shell):
+        self.shell = tuple(tuple(point) for point in shell)
+        if self.shell[0] != self.shell[-1]:
+            self.shell = self.shell + (self.shell[0],)
+        self._extent = None
+
+    # Matches GEOS: a tuple of rings, the first being the shell
+    @property
+    def coords(self):
+        return (self.shell,)
+
+    @property
+    def extent(self):
+        if self._extent is None:
+            self._extent = BBox.from_points(self.shell).extent
+        return self._extent
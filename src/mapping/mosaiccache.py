@@ -0,0 +1,72 @@
+import struct
+import numpy
+
+# Stores stitched mosaics as raw RGB pixels behind a small header, so a cached
+# mosaic can be opened with numpy.memmap instead of being decoded. Opening is
+# near instant, pixels are only read from disk when they are used, and worker
+# processes that open the same mosaic share its pages in the OS page cache.
+#
+# Header (little endian, HEADER_SIZE bytes, zero padded):
+#   magic, version, width, height, channels, zoom, ll_p_x, ll_p_y, ur_p_x, ur_p_y
+# where the pixel bounds are TMS pixels at the zoom level (origin bottom left),
+# followed by height * width * channels uint8 values in row order.
+class MosaicCache(object):
+
+    MAGIC           = 'BDMOSAIC'
+    VERSION         = 1
+    HEADER_FORMAT   = '<8sIIIIiiiii'
+    HEADER_SIZE     = 64
+
+    OBJ_TYPE        = 'bing_tiles'
+
+    def __init__(self, storagemanager):
+        self.storagemanager = storagemanager
+
+    # Returns a read only (height, width, channels) array mapped from the cached
+    # mosaic and its header as a dict, or (None, None) if it isn't cached
+    def get(self, name):
+        filename = self.storagemanager.get_local_filename(self.OBJ_TYPE, name)
+        if filename is None:
+            return None, None
+        return self.open(filename)
+
+    def put(self, name, pixels, zoom, pixel_bounds):
+        self.storagemanager.put(self.OBJ_TYPE, name, self.serialize(pixels, zoom, pixel_bounds), overwrite=True)
+
+    # Returns the local filename of a cached mosaic, e.g. to pass to another process
+    def get_local_filename(self, name):
+        return self.storagemanager.get_local_filename(self.OBJ_TYPE, name)
+
+    @classmethod
+    def open(cls, filename):
+        with open(filename, 'rb') as f:
+            header = cls.read_header(f.read(cls.HEADER_SIZE))
+        if header is None:
+            return None, None
+
+        shape = (header['height'], header['width'], header['channels'])
+        return numpy.memmap(filename, dtype=numpy.uint8, mode='r', offset=cls.HEADER_SIZE, shape=shape), header
+
+    @classmethod
+    def serialize(cls, pixels, zoom, pixel_bounds):
+        pixels = numpy.ascontiguousarray(pixels, dtype=numpy.uint8)
+        if pixels.ndim == 2:
+            pixels = pixels[:, :, None]
+
+        height, width, channels = pixels.shape
+        ll_p_x, ll_p_y, ur_p_x, ur_p_y = [int(value) for value in pixel_bounds]
+        header = struct.pack(cls.HEADER_FORMAT, cls.MAGIC, cls.VERSION, width, height, channels, zoom, ll_p_x, ll_p_y, ur_p_x, ur_p_y)
+
+        return header.ljust(cls.HEADER_SIZE, '\0') + pixels.tostring()
+
+    @classmethod
+    def read_header(cls, data):
+        if len(data) < struct.calcsize(cls.HEADER_FORMAT):
+            return None
+
+        values = struct.unpack_from(cls.HEADER_FORMAT, data)
+        if values[0] != cls.MAGIC or values[1] != cls.VERSION:
+            return None
+
+        keys = ['magic', 'version', 'width', 'height', 'channels', 'zoom', 'll_p_x', 'll_p_y', 'ur_p_x', 'ur_p_y']
+        return dict(zip(keys, values))
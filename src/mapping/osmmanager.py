@@ -1,49 +1,222 @@
-from utils import urlopen_with_retry
+import time
+import json
+import logging
+import urllib2
 import xml.etree.cElementTree as ET
-import django.contrib.gis.geos.collections
+from multiprocessing.pool import ThreadPool
+from mapping.footprints import FootprintCollection
+from mapping.tileutils import GlobalMercator
+from storage.storagemanager import getStorageManager
 
 class OSMManager():
 
-    # Get the raw building data from OSM
+    # The map call of the OSM API (or a compatible server)
+    API_URL         = "http://www.openstreetmap.org/api/0.6/map"
+
+    # Large areas are fetched as a grid of queries no bigger than this (in
+    # degrees), a few at a time. The API refuses areas over 0.25 square degrees
+    # or with more than 50000 nodes, queries it refuses are split into quarters.
+    MAX_QUERY_SIZE  = 0.02
+    MAX_SPLITS      = 4
+    THREADS         = 4
+
+    RETRIES         = 3
+    RETRY_WAIT      = 1.0   # seconds
+    TIMEOUT         = 180   # seconds
+
+    # OSM data is cached in osm_cache one map tile at a time (zoom 14 tiles are
+    # about 2.4km across at the equator), so overlapping or repeated areas only
+    # fetch the tiles that aren't cached yet. Cached tiles are fetched again
+    # once they are older than CACHE_TTL seconds (None = never), or after
+    # invalidateCache() is called for their area.
+    USE_CACHE       = True
+    CACHE_ZOOM      = 14
+    CACHE_TTL       = 7 * 24 * 60 * 60
+
+    def __init__(self, api_url=None):
+        self.api_url    = api_url or self.API_URL
+        self.mercator   = GlobalMercator()
+
+    # Get the raw building data from OSM for the min_lon (left), min_lat (right),
+    # max_lon (top), max_lat (bottom) bounding box
     def getBuildingData(self, left, right, top, bottom):
+        bbox = (left, right, top, bottom)
+
+        if not self.USE_CACHE:
+            nodes, ways = self._merge(self._map(self._fetch, self._splitBox(bbox)))
+            return self._buildFootprints(nodes, ways)
+
+        cells   = self._cacheCells(bbox)
+        results = dict((cell, self._getCachedCell(cell)) for cell in cells)
+        missing = [cell for cell in cells if results[cell] is None]
+
+        if missing:
+            logging.info("Fetching OSM data for %i of %i cache tiles" % (len(missing), len(cells)))
+            results.update(zip(missing, self._map(self._fetchCell, missing)))
+
+        # The cells cover more than the bbox, only keep the buildings the API returns for the bbox itself
+        nodes, ways = self._merge(results.values())
+        return self._buildFootprints(nodes, self._waysInBox(nodes, ways, bbox))
+
+    # Removes the cached OSM data for every cache tile overlapping the bbox so it is fetched again
+    def invalidateCache(self, left, right, top, bottom):
+        cells = self._cacheCells((left, right, top, bottom))
+        for cell in cells:
+            getStorageManager().delete("osm_cache", self._cellLocator(cell))
+        logging.info("Removed %i tiles from the OSM cache" % len(cells))
+
+    # The (x, y) TMS tiles at CACHE_ZOOM covering a (min_lon, min_lat, max_lon, max_lat) box
+    def _cacheCells(self, bbox):
+        min_lon, min_lat, max_lon, max_lat = bbox
+        min_x, min_y = self.mercator.MetersToTile(*(self.mercator.LatLonToMeters(min_lat, min_lon) + (self.CACHE_ZOOM,)))
+        max_x, max_y = self.mercator.MetersToTile(*(self.mercator.LatLonToMeters(max_lat, max_lon) + (self.CACHE_ZOOM,)))
+        return [(x, y) for y in range(min_y, max_y + 1) for x in range(min_x, max_x + 1)]
+
+    def _cellBox(self, cell):
+        min_lat, min_lon, max_lat, max_lon = self.mercator.TileLatLonBounds(cell[0], cell[1], self.CACHE_ZOOM)
+        return (min_lon, min_lat, max_lon, max_lat)
+
+    def _cellLocator(self, cell):
+        return "%i/%i/%i.json" % (self.CACHE_ZOOM, cell[0], cell[1])
+
+    # Returns the cached (nodes, ways) of a cell, or None if it isn't cached or has expired
+    def _getCachedCell(self, cell):
+        data = getStorageManager().get("osm_cache", self._cellLocator(cell))
+        if data is None:
+            return None
+
+        cached = json.loads(data)
+        if self.CACHE_TTL is not None and time.time() - cached['fetched'] > self.CACHE_TTL:
+            return None
+
+        nodes = dict((node_id, tuple(coords)) for node_id, coords in cached['nodes'].items())
+        ways  = dict((int(way_id), refs) for way_id, refs in cached['ways'].items())
+        return nodes, ways
 
-        response        = urlopen_with_retry("http://www.openstreetmap.org/api/0.6/map?bbox=%s,%s,%s,%s" % (left, right, top, bottom))
-        response_data   = response.read()
+    def _fetchCell(self, cell):
+        nodes, ways = self._merge([self._fetch(query) for query in self._splitBox(self._cellBox(cell))])
+        getStorageManager().put("osm_cache", self._cellLocator(cell), json.dumps({'fetched': time.time(), 'nodes': nodes, 'ways': ways}), overwrite=True)
+        return nodes, ways
 
-        xml_data =  ET.fromstring(response_data)
-        return self._processBuildingData(xml_data)
+    # The ways with at least one node inside the bbox, which is what the map call returns
+    def _waysInBox(self, nodes, ways, bbox):
+        min_lon, min_lat, max_lon, max_lat = bbox
 
-    # Reformats the existing building data from OSM so we can use it
+        inside = {}
+        for way_id, refs in ways.items():
+            for ref in refs:
+                coords = nodes.get(ref)
+                if coords is not None and min_lon <= coords[0] <= max_lon and min_lat <= coords[1] <= max_lat:
+                    inside[way_id] = refs
+                    break
+        return inside
+
+    # Runs func over the items, a few at a time
+    def _map(self, func, items):
+        if len(items) == 1:
+            return [func(items[0])]
+
+        pool = ThreadPool(min(self.THREADS, len(items)))
+        try:
+            return pool.map(func, items)
+        finally:
+            pool.close()
+            pool.join()
+
+    # Merges (nodes, ways) results. Buildings crossing the edge of a query are in more than one.
+    def _merge(self, results):
+        nodes   = {}
+        ways    = {}
+        for result_nodes, result_ways in results:
+            nodes.update(result_nodes)
+            ways.update(result_ways)
+        return nodes, ways
+
+    # Reformats the existing building data from OSM into a FootprintCollection
     def _processBuildingData(self, building_data):
+        nodes, ways = self._parseBuildingData(building_data)
+        return self._buildFootprints(nodes, ways)
 
-        polygons = []
+    # Returns {node id: (lon, lat)} for the visible nodes and {way id: [node ids]} for the buildings
+    def _parseBuildingData(self, building_data):
+        nodes = {}
+        for anode in building_data.iterfind("node[@visible='true']"):
+            nodes[anode.get('id')] = (float(anode.get('lon')), float(anode.get('lat')))
 
-        for abuilding in building_data.findall("way/tag[@k='building'][@v='yes']/.."):
-            coords = []
-            refs = {}
-            for aref in abuilding.findall('nd'):
+        ways = {}
+        for abuilding in building_data.iterfind("way/tag[@k='building'][@v='yes']/.."):
+            ways[int(abuilding.get('id'))] = [aref.get('ref') for aref in abuilding.iterfind('nd')]
 
-                # Some token caching
-                if aref.get('ref') in refs:
-                    coords.append(refs[aref.get('ref')])
-                    continue                    
-                
-                anode = building_data.find("./node[@id='%s'][@visible='true']/." % (aref.get('ref')))
-                coords.append((float(anode.get('lon')), float(anode.get('lat'))))
-                refs[aref.get('ref')] = (float(anode.get('lon')), float(anode.get('lat')))
+        return nodes, ways
+
+    def _buildFootprints(self, nodes, ways):
+
+        rings   = []
+        ids     = []
+
+        for way_id in sorted(ways):
+            refs = ways[way_id]
+            if any(ref not in nodes for ref in refs):
+                logging.warn("Skipping building %s, some of its nodes are missing" % way_id)
+                continue
 
+            coords = [nodes[ref] for ref in refs]
 
             if str(coords[0]) != str(coords[-1]):
                 coords.append(coords[0])
 
             if len(coords) > 3:
-                mpolygon = django.contrib.gis.geos.collections.Polygon(tuple(coords))
-                polygons.append(mpolygon)
+                rings.append(coords)
+                ids.append(way_id)
+
+        return FootprintCollection.from_rings(rings, ids)
+
+    # Splits a (min_lon, min_lat, max_lon, max_lat) box into a grid of boxes no bigger than size
+    def _splitBox(self, bbox, size=None):
+        size = size or self.MAX_QUERY_SIZE
+        min_lon, min_lat, max_lon, max_lat = bbox
+
+        columns = max(1, int(-(-(max_lon - min_lon) // size)))
+        rows    = max(1, int(-(-(max_lat - min_lat) // size)))
+        lons    = [min_lon + (max_lon - min_lon) * i / columns for i in range(columns)] + [max_lon]
+        lats    = [min_lat + (max_lat - min_lat) * i / rows for i in range(rows)] + [max_lat]
+
+        return [(lons[x], lats[y], lons[x + 1], lats[y + 1]) for y in range(rows) for x in range(columns)]
+
+    # Fetches and parses one box, splitting it into quarters if the API refuses it
+    def _fetch(self, bbox, splits=0):
+        try:
+            response_data = self._download("%s?bbox=%s,%s,%s,%s" % ((self.api_url,) + tuple(bbox)))
+        except urllib2.HTTPError, e:
+            if e.code != 400 or splits >= self.MAX_SPLITS:
+                raise
+            logging.info("OSM refused %s (%s), splitting it" % (bbox, e.read().strip()))
+
+            min_lon, min_lat, max_lon, max_lat = bbox
+            mid_lon = (min_lon + max_lon) / 2.0
+            mid_lat = (min_lat + max_lat) / 2.0
+
+            quarters = [(min_lon, min_lat, mid_lon, mid_lat), (mid_lon, min_lat, max_lon, mid_lat), (min_lon, mid_lat, mid_lon, max_lat), (mid_lon, mid_lat, max_lon, max_lat)]
+            return self._merge([self._fetch(quarter, splits + 1) for quarter in quarters])
+
+        return self._parseBuildingData(ET.fromstring(response_data))
 
-        return polygons
+    # Retries failed downloads, except for requests the API refused (4xx)
+    def _download(self, url):
+        for attempt in range(self.RETRIES):
+            try:
+                return urllib2.urlopen(url, timeout=self.TIMEOUT).read()
+            except urllib2.HTTPError, e:
+                if e.code < 500 or attempt == self.RETRIES - 1:
+                    raise
+            except urllib2.URLError:
+                if attempt == self.RETRIES - 1:
+                    raise
+            time.sleep(self.RETRY_WAIT)
 
-    # Generates a JOSM compatible output file containing the newly detected buildings
-    def generateOutputXml(self, minlat, minlon, maxlat, maxlon, building_coords):
+    # Generates a JOSM compatible output file containing the newly detected buildings.
+    # building_tags is an optional dict of extra tags for each building.
+    def generateOutputXml(self, minlat, minlon, maxlat, maxlon, building_coords, building_tags=None):
 
         id_count = 0
         
@@ -55,7 +228,7 @@ class OSMManager():
             'maxlon': str(maxlon)
             })
 
-        for building in building_coords:
+        for building_index, building in enumerate(building_coords):
 
             id_count = id_count - 1
             
@@ -65,6 +238,9 @@ class OSMManager():
                 'action'    : 'modify'
                 })
             ET.SubElement(way, 'tag', {'k': 'building', 'v': 'yes'})
+            if building_tags is not None:
+                for key, value in sorted(building_tags[building_index].items()):
+                    ET.SubElement(way, 'tag', {'k': key, 'v': value})
 
             first_node_id = id_count - 1
             
@@ -0,0 +1,47 @@
+import numpy
+
+# A static index of axis aligned boxes for overlap queries.
+#
+# Boxes are sorted by their left edge once (O(n log n)). A query only looks at
+# the boxes whose left edge lies between (query left - widest box) and the
+# query's right edge, found with a binary search, so each query costs
+# O(log n + k) for k nearby boxes.
+class BoxIndex(object):
+
+    # boxes is an (n, 4) array of (left, top, right, bottom)
+    def __init__(self, boxes):
+        boxes           = numpy.asarray(boxes, dtype=numpy.float64).reshape(-1, 4)
+        self.order      = numpy.argsort(boxes[:, 0], kind='mergesort')
+        self.boxes      = boxes[self.order]
+        self.max_width  = (self.boxes[:, 2] - self.boxes[:, 0]).max() if len(boxes) else 0
+
+        # Position of each original box in the sorted array
+        self.positions  = numpy.empty(len(self.order), dtype=numpy.int64)
+        self.positions[self.order] = numpy.arange(len(self.order))
+
+    def __len__(self):
+        return len(self.boxes)
+
+    # Indexes (into the original boxes array) of the boxes that overlap the query box
+    def query(self, box):
+        left, top, right, bottom = box
+        start   = numpy.searchsorted(self.boxes[:, 0], left - self.max_width, side='left')
+        end     = numpy.searchsorted(self.boxes[:, 0], right, side='right')
+
+        nearby  = self.boxes[start:end]
+        overlap = (nearby[:, 0] < right) & (nearby[:, 2] > left) & (nearby[:, 1] < bottom) & (nearby[:, 3] > top)
+        return self.order[start:end][overlap]
+
+    # Intersection over union of the query box with each of the given indexed boxes
+    def iou(self, box, indexes):
+        left, top, right, bottom = box
+        others = self.boxes[self.positions[indexes]]
+
+        width   = numpy.maximum(0, numpy.minimum(right, others[:, 2]) - numpy.maximum(left, others[:, 0]))
+        height  = numpy.maximum(0, numpy.minimum(bottom, others[:, 3]) - numpy.maximum(top, others[:, 1]))
+        intersection = width * height
+
+        area        = (right - left) * (bottom - top)
+        other_areas = (others[:, 2] - others[:, 0]) * (others[:, 3] - others[:, 1])
+        return intersection / numpy.maximum(area + other_areas - intersection, 1e-12)
+
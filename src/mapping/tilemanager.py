@@ -1,18 +1,35 @@
 import tileutils
+import numpy
+import os
+import hashlib
+import threading
+import collections
 from PIL import Image
 from utils import urlopen_with_retry
 import cStringIO
 from storage.storagemanager import getStorageManager
-import django.contrib.gis.geos.collections
+from mapping.geometry import LineString, MultiLineString
+from mapping.mosaiccache import MosaicCache
 
 class AbstractTileManager:
+    # Prepended to cached mosaic names so mosaics from different imagery sources don't collide
+    cache_prefix = ''
+
     def __init__(self):
         pass
 
-    def get_tile(self, x, y):
+    def get_tile(self, x, y, zoom):
         """must be implemented by subclass"""
         raise NotImplementedError
 
+    def prefetch_tile(self, x, y, zoom):
+        """makes sure a tile is available locally, only needed for remote sources"""
+        pass
+
+    def get_tile_hash(self, x, y, zoom):
+        """a hash that changes when the tile's imagery changes, subclasses can avoid decoding the tile"""
+        return hashlib.md5(self.get_tile(x, y, zoom).tobytes()).hexdigest()
+
 class BingTileManager(AbstractTileManager):
     def __init__(self):
         self.mt_counter = 0
@@ -33,33 +50,150 @@ class BingTileManager(AbstractTileManager):
         return self.layer_url_template(layer) % (counter, coord, version)
 
     def get_tile(self, x, y, zoom):
+        return Image.open(cStringIO.StringIO(self.get_tile_data(x, y, zoom)))
+
+    def prefetch_tile(self, x, y, zoom):
+        self.get_tile_data(x, y, zoom)
+
+    def get_tile_hash(self, x, y, zoom):
+        return hashlib.md5(self.get_tile_data(x, y, zoom)).hexdigest()
+
+    # Returns the raw PNG data for a tile, downloading it if it isn't cached
+    def get_tile_data(self, x, y, zoom):
         self.mt_counter += 1
         self.mt_counter = self.mt_counter % 4 #(count using 1-4 servers)
 
         gtx, gty        = self.mercator.GoogleTile(x, y, zoom)
         image_file      = self.storagemanager.get('bing_raw', "bing_%s_%s_%s_%s.png" % (zoom, gtx, gty, self.TILE_SIZE))
 
-        if image_file is not None:
-            return Image.open(cStringIO.StringIO(image_file))
-        else:
+        if image_file is None:
             quad_key = self.mercator.QuadTree(x, y, zoom)
 
             url = self.get_url(self.mt_counter, quad_key, 1)
             f = urlopen_with_retry(url)
             image_file = f.read()
             self.storagemanager.put('bing_raw', "bing_%s_%s_%s_%s.png" % (zoom, gtx, gty, self.TILE_SIZE), image_file)
-            return Image.open(cStringIO.StringIO(image_file))
+
+        return image_file
             
 
+# Serves tiles from a local raster (e.g. a GeoTIFF orthophoto) in any projection GDAL
+# understands. Each tile is a windowed read of just the area it covers, warped into
+# web mercator, so the raster is never loaded in full. GDAL picks the closest
+# overview when one exists.
+class RasterTileManager(AbstractTileManager):
+    def __init__(self, raster_filename, resampling='bilinear'):
+        self.TILE_SIZE = 256
+        self.mercator = tileutils.GlobalMercator()
+        self.raster_filename = os.path.abspath(raster_filename)
+        self.resampling = resampling
+        self.cache_prefix = 'raster_%s_' % hashlib.md5(self.raster_filename).hexdigest()[:8]
+
+        # GDAL dataset handles can't be shared between threads, so each thread keeps its own open handle
+        self.datasets = threading.local()
+
+    def get_dataset(self):
+        dataset = getattr(self.datasets, 'dataset', None)
+        if dataset is None:
+            from osgeo import gdal
+
+            dataset = gdal.Open(self.raster_filename)
+            if dataset is None:
+                raise IOError('Unable to open raster: %s' % self.raster_filename)
+            self.datasets.dataset = dataset
+        return dataset
+
+    def get_tile(self, x, y, zoom):
+        from osgeo import gdal
+
+        # Tile bounds in EPSG:3857 metres (x, y are TMS tile coordinates)
+        min_x, min_y, max_x, max_y = self.mercator.TileBounds(x, y, zoom)
+
+        tile = gdal.Warp('', self.get_dataset(),
+            format='MEM',
+            outputBounds=(min_x, min_y, max_x, max_y),
+            width=self.TILE_SIZE,
+            height=self.TILE_SIZE,
+            dstSRS='EPSG:3857',
+            resampleAlg=self.resampling
+            )
+
+        # Areas outside the raster come back black
+        pixels = tile.ReadAsArray()
+        if pixels.ndim == 2:
+            pixels = pixels[numpy.newaxis]
+
+        # Single band rasters are repeated into each channel, extra bands (alpha, NIR) are dropped
+        if pixels.shape[0] < 3:
+            pixels = numpy.repeat(pixels[:1], 3, axis=0)
+        pixels = numpy.ascontiguousarray(numpy.transpose(pixels[:3], (1, 2, 0)))
+
+        # Assumes 8 bit imagery
+        return Image.fromarray(pixels.astype(numpy.uint8), 'RGB')
+
+# Keeps the most recently used tiles of another tile manager decoded in memory,
+# for long running processes (see service.py) that keep detecting over the same
+# areas. Tiles are shared, so callers must not modify them.
+class MemoryTileManager(AbstractTileManager):
+
+    # About 200KB each once decoded
+    MAX_TILES = 512
+
+    def __init__(self, tile_manager, max_tiles=None):
+        self.tile_manager   = tile_manager
+        self.cache_prefix   = tile_manager.cache_prefix
+        self.max_tiles      = max_tiles or self.MAX_TILES
+        self.tiles          = collections.OrderedDict()
+        self.hashes         = collections.OrderedDict()
+        self.lock           = threading.Lock()
+
+    def get_tile(self, x, y, zoom):
+        tile = self._lookup(self.tiles, (x, y, zoom))
+        if tile is None:
+            tile = self.tile_manager.get_tile(x, y, zoom)
+            # Decode now rather than on first use by every caller
+            tile.load()
+            self._store(self.tiles, (x, y, zoom), tile)
+        return tile
+
+    def prefetch_tile(self, x, y, zoom):
+        if self._lookup(self.tiles, (x, y, zoom)) is None:
+            self.tile_manager.prefetch_tile(x, y, zoom)
+
+    def get_tile_hash(self, x, y, zoom):
+        tile_hash = self._lookup(self.hashes, (x, y, zoom))
+        if tile_hash is None:
+            tile_hash = self.tile_manager.get_tile_hash(x, y, zoom)
+            self._store(self.hashes, (x, y, zoom), tile_hash)
+        return tile_hash
+
+    def _lookup(self, cache, key):
+        with self.lock:
+            value = cache.pop(key, None)
+            if value is not None:
+                cache[key] = value
+            return value
+
+    def _store(self, cache, key, value):
+        with self.lock:
+            cache.pop(key, None)
+            cache[key] = value
+            while len(cache) > self.max_tiles:
+                cache.popitem(last=False)
+
+
 class StaticMapGenerator:
-    def __init__(self, li_zoom_levels, max_width = 1200, max_height = 1200, padding=0):
+    def __init__(self, li_zoom_levels, max_width = 1200, max_height = 1200, padding=0, tile_manager=None):
         self.MAX_MAP_WIDTH = max_width
         self.MAX_MAP_HEIGHT = max_height
         self.PADDING = padding
         self.mercator = tileutils.GlobalMercator()
         self.reset()
-        self.set_tile_manager(BingTileManager(), li_zoom_levels)
+        if tile_manager is None:
+            tile_manager = BingTileManager()
+        self.set_tile_manager(tile_manager, li_zoom_levels)
         self.storagemanager = getStorageManager()
+        self.mosaic_cache = MosaicCache(self.storagemanager)
 
     def reset(self):
         self.lines = []
@@ -156,6 +290,15 @@ class StaticMapGenerator:
         ry = self.ur_p_y - p_y
         return [rx, ry]
 
+    # Array version of x_y_for_lat_long, converts many points in one pass
+    def x_y_for_lat_long_array(self, lats, lngs):
+        m_x = numpy.asarray(lngs, dtype=numpy.float64) * self.mercator.originShift / 180.0
+        m_y = numpy.log(numpy.tan((90 + numpy.asarray(lats, dtype=numpy.float64)) * numpy.pi / 360.0)) / (numpy.pi / 180.0)
+        m_y = m_y * self.mercator.originShift / 180.0
+
+        p_x, p_y = self.mercator.MetersToPixels(m_x, m_y, self.zoom)
+        return p_x - self.ll_p_x, self.ur_p_y - p_y
+
     def lat_long_for_x_y(self, rx, ry):
         p_y = self.ur_p_y - ry
         p_x = self.ll_p_x + rx
@@ -163,29 +306,96 @@ class StaticMapGenerator:
         lat, long = self.mercator.MetersToLatLon(m_x, m_y)
         return [lat, long]
         
-    def get_tile_image(self, tile_coords):
+    # Sets the map to the area covered by tile_coords (left, top, right, bottom GPS coords)
+    def set_tile_coords(self, tile_coords):
 
         self.reset()
         top_coord       = (tile_coords[0], tile_coords[1])
         bottom_coord    = (tile_coords[2], tile_coords[3])
-        linestring      = django.contrib.gis.geos.collections.LineString((top_coord, bottom_coord))
-        mlinestring     = django.contrib.gis.geos.collections.MultiLineString([linestring])
+        linestring      = LineString((top_coord, bottom_coord))
+        mlinestring     = MultiLineString([linestring])
         
         self.add_line(mlinestring)
 
-        filename        = ','.join(str(item) for item in tile_coords)
-        
-        tile_image_data         = self.storagemanager.get('bing_tiles', "%s.png" % (filename))
-        if tile_image_data is None:
-            tile_image          = self.generate_static_map()
-            tile_image_bytes    = cStringIO.StringIO()
-            tile_image.save(tile_image_bytes, 'PNG')
-            self.storagemanager.put('bing_tiles', "%s.png" % (filename), tile_image_bytes.getvalue())
+    # Sets the map to an exact area in pixel coordinates (origin bottom left) at a zoom level
+    def set_pixel_bounds(self, ll_p_x, ll_p_y, ur_p_x, ur_p_y, zoom):
+        self.reset()
+        self.zoom = zoom
+        self.ll_p_x = ll_p_x
+        self.ll_p_y = ll_p_y
+        self.ur_p_x = ur_p_x
+        self.ur_p_y = ur_p_y
+
+        ll_m_x, ll_m_y = self.mercator.PixelsToMeters(self.ll_p_x, self.ll_p_y, self.zoom)
+        self.ll_lat, self.ll_long = self.mercator.MetersToLatLon(ll_m_x, ll_m_y)
+
+        self.image_width = self.ur_p_x - self.ll_p_x
+        self.image_height = self.ur_p_y - self.ll_p_y
+
+    def get_tile_manager(self):
+        return self.zoom_to_tile_manager[self.zoom or self.zoom_levels[0]]
+
+    # Returns the stitched image for tile_coords. With cache=False the stitched
+    # image isn't stored in (or loaded from) bing_tiles. export_png also stores
+    # it as a PNG named get_tile_image_name, for tools that need an image file.
+    def get_tile_image(self, tile_coords, cache=True, export_png=False):
+
+        if not cache:
+            self.set_tile_coords(tile_coords)
+            tile_image      = self.generate_static_map()
         else:
-            tile_image          = Image.open(cStringIO.StringIO(tile_image_data))
-            
+            tile_image      = Image.fromarray(numpy.asarray(self.get_tile_array(tile_coords)))
+
+        if export_png:
+            self.export_tile_png(tile_coords, tile_image)
+
         return tile_image
 
+    # Returns the stitched mosaic for tile_coords as a read only (height, width, 3)
+    # array mapped from the mosaic cache in bing_tiles (see MosaicCache)
+    def get_tile_array(self, tile_coords):
+
+        self.set_tile_coords(tile_coords)
+
+        filename            = self.get_tile_mosaic_name(tile_coords)
+        pixel_bounds        = (self.ll_p_x, self.ll_p_y, self.ur_p_x, self.ur_p_y)
+
+        pixels, header      = self.mosaic_cache.get(filename)
+        if pixels is not None and header['zoom'] == self.zoom and (header['ll_p_x'], header['ll_p_y'], header['ur_p_x'], header['ur_p_y']) == pixel_bounds:
+            return pixels
+
+        # Mosaics cached before the mosaic cache existed are converted rather than downloaded again
+        tile_image_data     = self.storagemanager.get('bing_tiles', self.get_tile_image_name(tile_coords))
+        if tile_image_data is not None:
+            tile_image      = Image.open(cStringIO.StringIO(tile_image_data)).convert('RGB')
+        else:
+            tile_image      = self.generate_static_map()
+
+        self.mosaic_cache.put(filename, numpy.asarray(tile_image), self.zoom, pixel_bounds)
+        pixels, header      = self.mosaic_cache.get(filename)
+        return pixels
+
+    # Stores the mosaic as a PNG, unless it has already been exported
+    def export_tile_png(self, tile_coords, tile_image=None):
+        filename            = self.get_tile_image_name(tile_coords)
+        if self.storagemanager.get_local_filename('bing_tiles', filename) is not None:
+            return
+
+        if tile_image is None:
+            tile_image      = self.get_tile_image(tile_coords)
+
+        tile_image_bytes    = cStringIO.StringIO()
+        tile_image.save(tile_image_bytes, 'PNG')
+        self.storagemanager.put('bing_tiles', filename, tile_image_bytes.getvalue())
+
+    # Name of the exported PNG for tile_coords (the GPS coords concated together)
+    def get_tile_image_name(self, tile_coords):
+        return "%s%s.png" % (self.get_tile_manager().cache_prefix, ','.join(str(item) for item in tile_coords))
+
+    # Name of the cached mosaic for tile_coords
+    def get_tile_mosaic_name(self, tile_coords):
+        return "%s%s.mosaic" % (self.get_tile_manager().cache_prefix, ','.join(str(item) for item in tile_coords))
+
     def generate_static_map(self):
         
         image = Image.new("RGB", (self.image_width, self.image_height))
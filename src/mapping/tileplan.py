@@ -0,0 +1,195 @@
+import logging
+from multiprocessing.pool import ThreadPool
+
+# Plans the imagery work for a whole run of (possibly overlapping) rectangles.
+#
+# All rectangles are converted to pixel bounds (TMS pixels at the map's zoom
+# level, origin bottom left) up front, so that:
+#  - the union of the imagery tiles they need can be fetched once, concurrently
+#  - the union of their areas can be split into non-overlapping windows, so
+#    pixels shared by several rectangles are only processed once
+#  - results found in the windows can be mapped back to every rectangle that
+#    contains them
+class TilePlan(object):
+
+    TILE_SIZE       = 256
+    # Windows larger than this (in pixels) are split to bound memory use
+    MAX_WINDOW_SIZE = 4096
+
+    # pool is a ThreadPool to fetch tiles on, by default one is started for each call
+    def __init__(self, map_generator, tiles_coords, pool=None):
+        self.map_generator  = map_generator
+        self.tiles_coords   = list(tiles_coords)
+        self.pool           = pool
+
+        # (ll_p_x, ll_p_y, ur_p_x, ur_p_y, zoom) for every rectangle
+        self.rectangles = []
+        for tile_coords in self.tiles_coords:
+            map_generator.set_tile_coords(tile_coords)
+            self.rectangles.append((map_generator.ll_p_x, map_generator.ll_p_y, map_generator.ur_p_x, map_generator.ur_p_y, map_generator.zoom))
+
+    # The (x, y, zoom) TMS tiles needed to stitch every rectangle, each listed once.
+    # Matches the tiles StaticMapGenerator.generate_static_map requests.
+    def tiles(self):
+        tiles = set()
+        for rectangle in self.rectangles:
+            tiles.update(self.stitch_tiles(rectangle[:4], rectangle[4]))
+
+        return sorted(tiles)
+
+    # The (x, y, zoom) tiles StaticMapGenerator.generate_static_map requests to
+    # stitch the (ll_p_x, ll_p_y, ur_p_x, ur_p_y) pixel bounds
+    def stitch_tiles(self, bounds, zoom):
+        ll_p_x, ll_p_y, ur_p_x, ur_p_y = bounds
+        start_tile_x, start_tile_y = self.map_generator.mercator.PixelsToTile(ll_p_x, ll_p_y)
+        end_tile_x = (ur_p_x + self.TILE_SIZE) // self.TILE_SIZE
+        end_tile_y = (ur_p_y + self.TILE_SIZE) // self.TILE_SIZE
+
+        return [(x, y, zoom) for x in range(start_tile_x, end_tile_x + 1) for y in range(start_tile_y, end_tile_y + 1)]
+
+    # Fetches every tile once so that stitching never waits on the network.
+    # tiles defaults to the tiles needed to stitch the rectangles.
+    def prefetch(self, tile_manager, threads=8, tiles=None):
+        if tiles is None:
+            tiles = self.tiles()
+        logging.info("Fetching %i imagery tiles for %i rectangles" % (len(tiles), len(self.rectangles)))
+
+        self._map(lambda tile: tile_manager.prefetch_tile(*tile), tiles, threads)
+
+    # Returns {(x, y, zoom): content hash} for the tiles (see AbstractTileManager.get_tile_hash)
+    def tile_hashes(self, tile_manager, tiles, threads=8):
+        return dict(zip(tiles, self._map(lambda tile: tile_manager.get_tile_hash(*tile), tiles, threads)))
+
+    # The (x, y, zoom) cells of the tile grid that overlap a rectangle, or are
+    # within margin pixels of one, where cell x, y holds the pixels
+    # x * TILE_SIZE <= p_x < (x + 1) * TILE_SIZE (and the same for p_y)
+    def grid_cells(self, margin=0):
+        cells = set()
+        for ll_p_x, ll_p_y, ur_p_x, ur_p_y, zoom in self.rectangles:
+            ll_p_x, ll_p_y, ur_p_x, ur_p_y = ll_p_x - margin, ll_p_y - margin, ur_p_x + margin, ur_p_y + margin
+            for x in range(ll_p_x // self.TILE_SIZE, (ur_p_x - 1) // self.TILE_SIZE + 1):
+                for y in range(ll_p_y // self.TILE_SIZE, (ur_p_y - 1) // self.TILE_SIZE + 1):
+                    cells.add((x, y, zoom))
+
+        return sorted(cells)
+
+    # Like windows() but for a list of grid cells: the cells are merged into
+    # windows whose edges lie on the tile grid, and every window is extended by
+    # the full halo (the tiles around the cells need to be available).
+    def cell_windows(self, cells, halo=0):
+        windows = []
+        for zoom in sorted(set(cell[2] for cell in cells)):
+            for cover in self._cellCover([(x, y) for x, y, cell_zoom in cells if cell_zoom == zoom]):
+                for core in self._splitLarge([tuple(value * self.TILE_SIZE for value in cover)]):
+                    windows.append((core, (core[0] - halo, core[1] - halo, core[2] + halo, core[3] + halo), zoom))
+
+        return windows
+
+    # Splits the union of the rectangles into non-overlapping windows.
+    # Returns a list of (core, extended, zoom) where core is the window's own
+    # (ll_p_x, ll_p_y, ur_p_x, ur_p_y) area and extended adds up to halo pixels
+    # on each side (within the rectangles it touches) so that objects crossing
+    # the window edge are seen in full.
+    def windows(self, halo=0):
+        windows = []
+        for zoom in sorted(set(rectangle[4] for rectangle in self.rectangles)):
+            rectangles = [rectangle[:4] for rectangle in self.rectangles if rectangle[4] == zoom]
+
+            for core in self._splitLarge(self._disjointCover(rectangles)):
+                windows.append((core, self._extend(core, rectangles, halo), zoom))
+
+        return windows
+
+    # Indexes of the rectangles that share some area with the (ll_p_x, ll_p_y, ur_p_x, ur_p_y) box
+    def rectangles_overlapping(self, box):
+        return [index for index, (ll_p_x, ll_p_y, ur_p_x, ur_p_y, zoom) in enumerate(self.rectangles)
+                if box[0] < ur_p_x and ll_p_x < box[2] and box[1] < ur_p_y and ll_p_y < box[3]]
+
+    # Covers the union of the rectangles with disjoint rectangles using the grid
+    # formed by all of their edges, merging covered cells into runs along x and
+    # then merging identical runs in neighbouring rows
+    def _disjointCover(self, rectangles):
+        xs = sorted(set([rectangle[0] for rectangle in rectangles] + [rectangle[2] for rectangle in rectangles]))
+        ys = sorted(set([rectangle[1] for rectangle in rectangles] + [rectangle[3] for rectangle in rectangles]))
+
+        rows = []
+        for y0, y1 in zip(ys[:-1], ys[1:]):
+            runs = []
+            run_start = None
+            for x0, x1 in zip(xs[:-1], xs[1:]):
+                covered = any(r[0] <= x0 and x1 <= r[2] and r[1] <= y0 and y1 <= r[3] for r in rectangles)
+                if covered and run_start is None:
+                    run_start = x0
+                if not covered and run_start is not None:
+                    runs.append((run_start, x0))
+                    run_start = None
+            if run_start is not None:
+                runs.append((run_start, xs[-1]))
+            rows.append((y0, y1, runs))
+
+        return self._mergeRows(rows)
+
+    # The same cover for a set of (x, y) grid cells, in cell units. Runs are read
+    # straight off the sorted cells, so this is fast for many cells.
+    def _cellCover(self, cells):
+        rows = []
+        for x, y in sorted(set(cells), key=lambda cell: (cell[1], cell[0])):
+            if not rows or rows[-1][0] != y:
+                rows.append((y, y + 1, []))
+            runs = rows[-1][2]
+            if runs and runs[-1][1] == x:
+                runs[-1] = (runs[-1][0], x + 1)
+            else:
+                runs.append((x, x + 1))
+
+        return self._mergeRows(rows)
+
+    # Merges identical runs in neighbouring rows of (y0, y1, [(x0, x1), ...]) into rectangles
+    def _mergeRows(self, rows):
+        cover = []
+        open_runs = {}
+        for y0, y1, runs in rows:
+            next_open = {}
+            for run in runs:
+                if run in open_runs and open_runs[run][3] == y0:
+                    x0, start_y, x1, end_y = open_runs.pop(run)
+                    next_open[run] = (x0, start_y, x1, y1)
+                else:
+                    next_open[run] = (run[0], y0, run[1], y1)
+            cover.extend(open_runs.values())
+            open_runs = next_open
+        cover.extend(open_runs.values())
+
+        return sorted(cover)
+
+    def _map(self, function, items, threads):
+        if self.pool is not None:
+            return self.pool.map(function, items)
+
+        pool = ThreadPool(threads)
+        try:
+            return pool.map(function, items)
+        finally:
+            pool.close()
+            pool.join()
+
+    def _splitLarge(self, windows):
+        split = []
+        for ll_p_x, ll_p_y, ur_p_x, ur_p_y in windows:
+            for x in range(ll_p_x, ur_p_x, self.MAX_WINDOW_SIZE):
+                for y in range(ll_p_y, ur_p_y, self.MAX_WINDOW_SIZE):
+                    split.append((x, y, min(x + self.MAX_WINDOW_SIZE, ur_p_x), min(y + self.MAX_WINDOW_SIZE, ur_p_y)))
+        return split
+
+    # Grows the window by halo pixels, but not past the bounding box of the rectangles it touches
+    def _extend(self, core, rectangles, halo):
+        ll_p_x, ll_p_y, ur_p_x, ur_p_y = core
+        extended = (ll_p_x - halo, ll_p_y - halo, ur_p_x + halo, ur_p_y + halo)
+
+        touching = [r for r in rectangles if r[0] < extended[2] and extended[0] < r[2] and r[1] < extended[3] and extended[1] < r[3]]
+        return (
+            max(extended[0], min(r[0] for r in touching)),
+            max(extended[1], min(r[1] for r in touching)),
+            min(extended[2], max(r[2] for r in touching)),
+            min(extended[3], max(r[3] for r in touching))
+            )
@@ -0,0 +1,204 @@
+import json
+import time
+import logging
+import threading
+import Queue
+import BaseHTTPServer
+import SocketServer
+from storage.storagemanager import getStorageManager
+from storage.resultstore import ResultStore
+from mapping.tilemanager import BingTileManager, MemoryTileManager
+from detect import Detect
+
+# Runs Detect as a long running service so that the imports, the cascade and
+# the tile caches are loaded once rather than for every area.
+#
+# Jobs are submitted over a local HTTP API and run by a fixed number of worker
+# threads, each with its own Detect (and so its own loaded cascade, fetching
+# threads and in-memory cache of recently used imagery tiles). Output is
+# written to the normal storage layout and the results database.
+#
+#   POST /jobs          {"coords": [[lat, lon, lat, lon], ...], "wait": false, "image": false}
+#                       queues a job and returns its ID (503 if the queue is full).
+#                       With "wait": true the response is sent when the job finishes.
+#                       With "image": true the images with the buildings drawn on
+#                       are written as well as the JOSM XML files.
+#   GET  /jobs/<id>     the state and result of a job
+#   GET  /status        workers, queue length and job counts
+class DetectionService:
+
+    # Finished jobs are forgotten once there are more than this many
+    MAX_FINISHED_JOBS = 1000
+
+    def __init__(self, tile_manager=None, workers=2, max_queue=100, zoom=19):
+        self.tile_manager   = tile_manager
+        self.zoom           = zoom
+        self.workers        = workers
+        self.queue          = Queue.Queue(max_queue)
+        # Workers share one connection to the results database
+        self.results        = ResultStore() if Detect.RECORD_RESULTS == True else None
+
+        self.jobs           = {}
+        self.finished       = []
+        self.job_count      = 0
+        self.busy           = 0
+        self.started        = time.time()
+        self._lock          = threading.Lock()
+
+    # Loads a Detect for every worker and starts them
+    def start(self):
+        for worker_id in range(self.workers):
+            detect          = Detect(MemoryTileManager(self.tile_manager or BingTileManager()), zoom=self.zoom)
+            detect.results  = self.results
+            detect._getEngine()
+
+            thread = threading.Thread(target=self._work, args=(detect,), name="detect-worker-%i" % (worker_id + 1))
+            thread.daemon = True
+            thread.start()
+
+        logging.info("Started %i detection workers" % self.workers)
+
+    def serve(self, host='127.0.0.1', port=8080):
+        self.start()
+
+        server = _HTTPServer((host, port), _RequestHandler)
+        server.service = self
+        logging.info("Listening on http://%s:%i/" % (host, port))
+
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            getStorageManager().flush()
+
+    # Queues a job for the list of (lat, lon, lat, lon) rectangles, returns the
+    # job or None if the queue is full
+    def submit(self, coords, image=False):
+        with self._lock:
+            self.job_count += 1
+            job = {
+                'job_id'    : self.job_count,
+                'status'    : 'queued',
+                'coords'    : coords,
+                'image'     : image,
+                'submitted' : time.time(),
+                'done'      : threading.Event()
+                }
+            self.jobs[job['job_id']] = job
+
+        try:
+            self.queue.put_nowait(job)
+        except Queue.Full:
+            with self._lock:
+                del self.jobs[job['job_id']]
+            return None
+
+        return job
+
+    def get_job(self, job_id):
+        with self._lock:
+            return self.jobs.get(job_id)
+
+    def status(self):
+        with self._lock:
+            statuses = [job['status'] for job in self.jobs.values()]
+            return {
+                'workers'   : self.workers,
+                'busy'      : self.busy,
+                'queued'    : self.queue.qsize(),
+                'done'      : statuses.count('done'),
+                'failed'    : statuses.count('failed'),
+                'uptime'    : time.time() - self.started
+                }
+
+    def _work(self, detect):
+        while True:
+            job = self.queue.get()
+
+            with self._lock:
+                self.busy += 1
+                job['status']   = 'running'
+                job['started']  = time.time()
+
+            try:
+                output = detect.processTiles(job['coords'], write_images=job['image'])
+                # The detector returns numpy integers, which json can't serialise
+                job['result'] = [{'tile_coords': [float(value) for value in tile_coords], 'buildings': [[int(value) for value in building] for building in buildings]} for tile_coords, buildings in output]
+                job['status'] = 'done'
+            except Exception, e:
+                logging.exception("Job %i failed" % job['job_id'])
+                job['error']  = str(e)
+                job['status'] = 'failed'
+
+            with self._lock:
+                self.busy -= 1
+                job['finished'] = time.time()
+                self.finished.append(job['job_id'])
+                while len(self.finished) > self.MAX_FINISHED_JOBS:
+                    self.jobs.pop(self.finished.pop(0), None)
+
+            job['done'].set()
+
+
+class _HTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class _RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        service = self.server.service
+
+        if self.path == '/status':
+            return self._send(200, service.status())
+
+        if self.path.startswith('/jobs/'):
+            try:
+                job = service.get_job(int(self.path[len('/jobs/'):]))
+            except ValueError:
+                job = None
+            if job is None:
+                return self._send(404, {'error': 'Unknown job'})
+            return self._send(200, self._jobData(job))
+
+        self._send(404, {'error': 'Unknown path'})
+
+    def do_POST(self):
+        service = self.server.service
+
+        if self.path != '/jobs':
+            return self._send(404, {'error': 'Unknown path'})
+
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.getheader('Content-Length', 0))))
+            coords  = [[float(value) for value in tile] for tile in request['coords']]
+            if len(coords) == 0 or any(len(tile) != 4 for tile in coords):
+                raise ValueError("coords must be a list of [lat, lon, lat, lon] rectangles")
+        except (ValueError, KeyError, TypeError), e:
+            return self._send(400, {'error': 'Bad request: %s' % e})
+
+        job = service.submit(coords, bool(request.get('image')))
+        if job is None:
+            return self._send(503, {'error': 'Job queue is full'})
+
+        if request.get('wait'):
+            job['done'].wait()
+            return self._send(200, self._jobData(job))
+
+        self._send(202, self._jobData(job))
+
+    def _jobData(self, job):
+        return dict((key, value) for key, value in job.items() if key != 'done')
+
+    def _send(self, code, data):
+        body = json.dumps(data)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.info("%s %s" % (self.address_string(), format % args))
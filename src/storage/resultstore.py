@@ -0,0 +1,173 @@
+import os
+import errno
+import json
+import time
+import sqlite3
+import threading
+
+# Keeps every detection from every run in one SQLite database so that areas can
+# be queried, counted and exported without parsing the per-rectangle output
+# files or running the detector again.
+#
+# Each run records the training ID, the hash of the cascade it used and its
+# settings. Detections are stored as (min_lon, min_lat, max_lon, max_lat)
+# boxes with an R-tree index, so bounding box queries only touch the
+# detections that overlap the box.
+#
+# The database is a local file, output/results.sqlite next to the other
+# output (even when --storage points at a bucket) as SQLite needs random
+# access to it.
+class ResultStore:
+
+	def __init__(self, filename=None):
+		if filename is None:
+			filename = os.path.join(os.path.dirname(__file__), "../output/results.sqlite")
+			try:
+				os.makedirs(os.path.dirname(filename))
+			except OSError, e:
+				if e.errno != errno.EEXIST:
+					raise
+		self.filename	= filename
+
+		# The connection is shared between threads, the lock serialises access to it
+		self._lock		= threading.Lock()
+		self._db		= sqlite3.connect(filename, check_same_thread=False)
+		self._db.execute("PRAGMA journal_mode=WAL")
+		self._createTables()
+
+	def _createTables(self):
+		with self._lock:
+			with self._db:
+				self._db.execute("""CREATE TABLE IF NOT EXISTS runs (
+					run_id			INTEGER PRIMARY KEY,
+					train_id		TEXT NOT NULL,
+					cascade_hash	TEXT NOT NULL,
+					started			REAL NOT NULL,
+					settings		TEXT
+					)""")
+				self._db.execute("""CREATE TABLE IF NOT EXISTS detections (
+					detection_id	INTEGER PRIMARY KEY,
+					run_id			INTEGER NOT NULL REFERENCES runs(run_id),
+					min_lon			REAL NOT NULL,
+					min_lat			REAL NOT NULL,
+					max_lon			REAL NOT NULL,
+					max_lat			REAL NOT NULL
+					)""")
+				self._db.execute("CREATE INDEX IF NOT EXISTS detections_run ON detections(run_id)")
+				self._db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS detections_index USING rtree(detection_id, min_lon, max_lon, min_lat, max_lat)")
+
+	# Records a new run and returns its ID
+	def start_run(self, train_id, cascade_hash, settings=None):
+		with self._lock:
+			with self._db:
+				cursor = self._db.execute("INSERT INTO runs (train_id, cascade_hash, started, settings) VALUES (?, ?, ?, ?)",
+					(train_id, cascade_hash, time.time(), json.dumps(settings)))
+				return cursor.lastrowid
+
+	# Adds (min_lon, min_lat, max_lon, max_lat) boxes to a run in one transaction
+	def add_detections(self, run_id, boxes):
+		boxes = [[float(value) for value in box] for box in boxes]
+		if len(boxes) == 0:
+			return
+
+		with self._lock:
+			with self._db:
+				# SQLite assigns the IDs, so other processes writing to the database can't take the same ones
+				self._db.executemany("INSERT INTO detections (run_id, min_lon, min_lat, max_lon, max_lat) VALUES (?, ?, ?, ?, ?)",
+					[(run_id,) + tuple(box) for box in boxes])
+				# Both inserts are in one transaction, so the new rows are the run's rows that aren't indexed yet
+				self._db.execute("""INSERT INTO detections_index (detection_id, min_lon, max_lon, min_lat, max_lat)
+					SELECT d.detection_id, d.min_lon, d.max_lon, d.min_lat, d.max_lat FROM detections d
+					WHERE d.run_id = ? AND NOT EXISTS (SELECT 1 FROM detections_index i WHERE i.detection_id = d.detection_id)""",
+					(run_id,))
+
+	# Detections overlapping the (min_lon, min_lat, max_lon, max_lat) bbox, optionally
+	# limited to a training ID, cascade or run. Returns a list of dicts.
+	def query(self, bbox, train_id=None, cascade_hash=None, run_id=None):
+		sql, params = self._select("""SELECT d.detection_id, d.run_id, r.train_id, r.cascade_hash, d.min_lon, d.min_lat, d.max_lon, d.max_lat
+			FROM detections_index i JOIN detections d ON d.detection_id = i.detection_id JOIN runs r ON r.run_id = d.run_id""",
+			bbox, train_id, cascade_hash, run_id)
+
+		columns = ['detection_id', 'run_id', 'train_id', 'cascade_hash', 'min_lon', 'min_lat', 'max_lon', 'max_lat']
+		with self._lock:
+			return [dict(zip(columns, row)) for row in self._db.execute(sql + " ORDER BY d.detection_id", params)]
+
+	# Number and extent of the detections of each run, optionally only those overlapping bbox
+	def stats(self, bbox=None, train_id=None, cascade_hash=None, run_id=None):
+		sql, params = self._select("""SELECT r.run_id, r.train_id, r.cascade_hash, r.started, r.settings,
+				COUNT(d.detection_id), MIN(d.min_lon), MIN(d.min_lat), MAX(d.max_lon), MAX(d.max_lat)
+			FROM detections_index i JOIN detections d ON d.detection_id = i.detection_id JOIN runs r ON r.run_id = d.run_id""",
+			bbox, train_id, cascade_hash, run_id)
+
+		stats = []
+		with self._lock:
+			for row in self._db.execute(sql + " GROUP BY r.run_id ORDER BY r.run_id", params):
+				stats.append({
+					'run_id'		: row[0],
+					'train_id'		: row[1],
+					'cascade_hash'	: row[2],
+					'started'		: row[3],
+					'settings'		: json.loads(row[4]) if row[4] else None,
+					'detections'	: row[5],
+					'extent'		: list(row[6:10])
+					})
+		return stats
+
+	# The detections overlapping bbox as a JOSM XML document, the same format Detect writes
+	def export_osm(self, bbox, **filters):
+		from mapping.osmmanager import OSMManager
+
+		buildings = [[[detection['max_lat'], detection['min_lon']], [detection['min_lat'], detection['max_lon']]] for detection in self.query(bbox, **filters)]
+		min_lon, min_lat, max_lon, max_lat = bbox
+		return OSMManager().generateOutputXml(min_lat, min_lon, max_lat, max_lon, buildings)
+
+	# The detections overlapping bbox as a GeoJSON FeatureCollection of rectangles
+	def export_geojson(self, bbox, **filters):
+		features = []
+		for detection in self.query(bbox, **filters):
+			min_lon, min_lat, max_lon, max_lat = detection['min_lon'], detection['min_lat'], detection['max_lon'], detection['max_lat']
+			features.append({
+				'type'		: 'Feature',
+				'id'		: detection['detection_id'],
+				'geometry'	: {
+					'type'			: 'Polygon',
+					'coordinates'	: [[[min_lon, min_lat], [max_lon, min_lat], [max_lon, max_lat], [min_lon, max_lat], [min_lon, min_lat]]]
+					},
+				'properties': {
+					'building'		: 'yes',
+					'run_id'		: detection['run_id'],
+					'train_id'		: detection['train_id'],
+					'cascade_hash'	: detection['cascade_hash']
+					}
+				})
+
+		return json.dumps({'type': 'FeatureCollection', 'bbox': list(bbox), 'features': features})
+
+	def close(self):
+		with self._lock:
+			self._db.close()
+
+	# Adds the bbox and filter conditions to a query over detections_index i, detections d and runs r
+	def _select(self, sql, bbox, train_id, cascade_hash, run_id):
+		conditions	= []
+		params		= []
+
+		if bbox is not None:
+			min_lon, min_lat, max_lon, max_lat = bbox
+			# The R-tree stores rounded values, so the exact test is repeated on the detections table
+			conditions.append("i.max_lon >= ? AND i.min_lon <= ? AND i.max_lat >= ? AND i.min_lat <= ?")
+			conditions.append("d.max_lon >= ? AND d.min_lon <= ? AND d.max_lat >= ? AND d.min_lat <= ?")
+			params.extend([min_lon, max_lon, min_lat, max_lat] * 2)
+		if train_id is not None:
+			conditions.append("r.train_id = ?")
+			params.append(train_id)
+		if cascade_hash is not None:
+			conditions.append("r.cascade_hash = ?")
+			params.append(cascade_hash)
+		if run_id is not None:
+			conditions.append("r.run_id = ?")
+			params.append(run_id)
+
+		if conditions:
+			sql = sql + " WHERE " + " AND ".join(conditions)
+		return sql, params
@@ -0,0 +1,232 @@
+import os
+import logging
+import hashlib
+import threading
+import cStringIO
+from multiprocessing.pool import ThreadPool
+from storage.storagemanager import AbstractStorage, LocalStorage
+
+# Stores objects in an S3 compatible object store (AWS S3, MinIO, Ceph, or a
+# local stand-in such as moto_server) so that many workers can share one tile
+# cache and output bucket.
+#
+# Objects use the same keys as LocalStorage (under an optional prefix), so a
+# bucket can be synced to a local folder with 'aws s3 sync' and used as is.
+# Everything read or written also goes into a local read-through cache.
+# Cached copies are checked against the object's ETag before they are used
+# (other workers may have replaced or removed it), except for the types in
+# IMMUTABLE_TYPES whose content never changes once stored.
+# Uploads run in the background on a pool of pooled connections, large objects
+# are sent as multipart uploads, and flush() waits for outstanding uploads
+# and raises the first upload error since the last flush.
+#
+# The connections and upload threads don't survive a fork, so a process
+# forked from one using the storage (e.g. a multiprocessing worker) creates
+# its own the first time it uses it.
+class S3Storage(AbstractStorage):
+
+	MAX_CONNECTIONS			= 16
+	MULTIPART_THRESHOLD		= 16 * 1024 * 1024
+	MULTIPART_CHUNKSIZE		= 8 * 1024 * 1024
+	# put() blocks once this many uploads are waiting
+	MAX_PENDING_UPLOADS		= 256
+	# Imagery and content keyed results, cached copies of these are used without checking the bucket
+	IMMUTABLE_TYPES			= ["bing_raw", "bing_tiles", "detector_tiles", "detector_cache"]
+
+	def __init__(self, output_id, bucket, prefix='', endpoint_url=None, cache_root=None):
+		from boto3.s3.transfer import TransferConfig
+
+		self.output_id	= output_id
+		self.bucket		= bucket
+		self.prefix		= prefix.strip('/')
+		self.endpoint_url = endpoint_url
+
+		self.transfer_config = TransferConfig(
+			multipart_threshold=self.MULTIPART_THRESHOLD,
+			multipart_chunksize=self.MULTIPART_CHUNKSIZE,
+			max_concurrency=self.MAX_CONNECTIONS,
+			use_threads=True
+			)
+
+		if cache_root is None:
+			cache_root = os.path.join(os.path.dirname(__file__), "../s3_cache/%s" % bucket)
+		self.cache		= LocalStorage(output_id, root=cache_root)
+
+		self._connect()
+
+	def _connect(self):
+		import boto3
+		from botocore.config import Config
+
+		# boto3 clients are thread safe and keep a pool of connections
+		self.client		= boto3.session.Session().client('s3', endpoint_url=self.endpoint_url, config=Config(max_pool_connections=self.MAX_CONNECTIONS))
+
+		self._pool		= ThreadPool(self.MAX_CONNECTIONS)
+		# put_many() runs on its own pool so it can't starve the uploads it queues
+		self._batch_pool = ThreadPool(self.MAX_CONNECTIONS)
+		self._pending	= []
+		self._pending_lock = threading.Lock()
+		# key -> number of queued uploads, their cached copies are newer than the bucket's
+		self._uploading	= {}
+		self._errors	= []
+		self._slots		= threading.BoundedSemaphore(self.MAX_PENDING_UPLOADS)
+		self._pid		= os.getpid()
+
+	# Reconnects if this is a forked copy of the process that connected
+	def _checkProcess(self):
+		if self._pid != os.getpid():
+			self._connect()
+
+	def build_uri(self, obj_type, locator):
+		return "s3://%s/%s" % (self.bucket, self._key(obj_type, locator))
+
+	def get(self, obj_type, locator, output_id=None):
+		data = self.cache.get(obj_type, locator, output_id)
+		if data is not None and (obj_type in self.IMMUTABLE_TYPES or self._isCurrent(self._key(obj_type, locator, output_id), data)):
+			return data
+
+		self._checkProcess()
+
+		from botocore.exceptions import ClientError
+		try:
+			response = self.client.get_object(Bucket=self.bucket, Key=self._key(obj_type, locator, output_id))
+		except ClientError, e:
+			if e.response['Error']['Code'] in ['NoSuchKey', '404']:
+				# Removed from the bucket by another worker
+				if data is not None:
+					self._removeCached(obj_type, locator, output_id)
+				return None
+			raise
+
+		data = response['Body'].read()
+		if output_id is None or output_id == self.output_id:
+			self.cache.put(obj_type, locator, data, overwrite=True)
+		else:
+			# Objects of other runs are only read, so they bypass the write queue
+			filename = self.cache.build_filename(obj_type, locator, output_id)
+			self.cache._makedirs(os.path.dirname(filename))
+			self.cache._write_atomic([(filename, data)])
+		return data
+
+	def put(self, obj_type, locator, obj, overwrite=False):
+		uri = self.build_uri(obj_type, locator)
+		self._checkProcess()
+
+		if obj:
+			if overwrite is False and self._exists(obj_type, locator):
+				return uri
+
+			# Readers in this process are served from the cache until the upload finishes
+			self.cache.put(obj_type, locator, obj, overwrite=True)
+			self._upload(self._key(obj_type, locator), obj)
+
+		return uri
+
+	# Checks and queues a batch of objects concurrently
+	def put_many(self, obj_type, items, overwrite=False):
+		self._checkProcess()
+		return self._batch_pool.map(lambda item: self.put(obj_type, item[0], item[1], overwrite), items)
+
+	def delete(self, obj_type, locator):
+		# Queued uploads could otherwise recreate the object afterwards
+		self.flush()
+		self.client.delete_object(Bucket=self.bucket, Key=self._key(obj_type, locator))
+		self.cache.delete(obj_type, locator)
+
+	def get_local_filename(self, obj_type, locator, output_id=None):
+		if self.get(obj_type, locator, output_id) is None:
+			return None
+		return self.cache.get_local_filename(obj_type, locator, output_id)
+
+	def flush(self):
+		self._checkProcess()
+		with self._pending_lock:
+			pending, self._pending = self._pending, []
+
+		for result in pending:
+			result.wait()
+		self.cache.flush()
+
+		with self._pending_lock:
+			errors, self._errors = self._errors, []
+		if errors:
+			raise errors[0]
+
+	def _key(self, obj_type, locator, output_id=None):
+		key = self.build_key(obj_type, locator, output_id)
+		if self.prefix:
+			key = "%s/%s" % (self.prefix, key)
+		return key
+
+	def _exists(self, obj_type, locator):
+		if self.cache.get_local_filename(obj_type, locator) is not None:
+			return True
+
+		from botocore.exceptions import ClientError
+		try:
+			self.client.head_object(Bucket=self.bucket, Key=self._key(obj_type, locator))
+		except ClientError, e:
+			if e.response['Error']['Code'] in ['NoSuchKey', '404']:
+				return False
+			raise
+		return True
+
+	def _upload(self, key, obj):
+		self._slots.acquire()
+		with self._pending_lock:
+			self._uploading[key] = self._uploading.get(key, 0) + 1
+		result = self._pool.apply_async(self._uploadNow, (key, obj))
+		with self._pending_lock:
+			self._pending = [pending for pending in self._pending if not pending.ready()]
+			self._pending.append(result)
+
+	def _uploadNow(self, key, obj):
+		try:
+			# upload_fileobj switches to a multipart upload above MULTIPART_THRESHOLD
+			self.client.upload_fileobj(cStringIO.StringIO(obj), self.bucket, key, Config=self.transfer_config)
+		except Exception, e:
+			logging.error('Error uploading %s to %s: %s' % (key, self.bucket, e))
+			with self._pending_lock:
+				self._errors.append(e)
+		finally:
+			with self._pending_lock:
+				self._uploading[key] -= 1
+				if self._uploading[key] == 0:
+					del self._uploading[key]
+			self._slots.release()
+
+	# Whether a cached copy matches the object in the bucket (checked with a HEAD request)
+	def _isCurrent(self, key, data):
+		self._checkProcess()
+		with self._pending_lock:
+			if key in self._uploading:
+				return True
+
+		from botocore.exceptions import ClientError
+		try:
+			response = self.client.head_object(Bucket=self.bucket, Key=key)
+		except ClientError, e:
+			if e.response['Error']['Code'] in ['NoSuchKey', '404']:
+				return False
+			raise
+		return response['ETag'].strip('"') == self._etag(data)
+
+	# The ETag S3 gives an object uploaded with transfer_config: the MD5 of the
+	# data, or for multipart uploads the MD5 of the parts' MD5s and the part count
+	def _etag(self, data):
+		if len(data) < self.MULTIPART_THRESHOLD:
+			return hashlib.md5(data).hexdigest()
+
+		parts = [hashlib.md5(data[start:start + self.MULTIPART_CHUNKSIZE]).digest() for start in range(0, len(data), self.MULTIPART_CHUNKSIZE)]
+		return "%s-%i" % (hashlib.md5(''.join(parts)).hexdigest(), len(parts))
+
+	def _removeCached(self, obj_type, locator, output_id=None):
+		if output_id is None or output_id == self.output_id:
+			self.cache.delete(obj_type, locator)
+			return
+
+		# Objects of other runs are written directly, never queued
+		try:
+			os.remove(self.cache.build_filename(obj_type, locator, output_id))
+		except OSError:
+			pass
@@ -1,5 +1,10 @@
 import os
+import errno
+import atexit
 import logging
+import tempfile
+import threading
+import Queue
 
 class StorageManager():
 	def initalise(self, output_id, manager=None):
@@ -18,10 +23,26 @@ def getStorageManager():
 		return storageManager.manager
 	
 class AbstractStorage:
+	# Object types that are shared between training runs rather than stored per output_id
+	CACHE_TYPES = ["bing_raw", "osm_cache"]
+
 	def __init__(self):
 		pass
 
-	def get(self, type, locator):
+	# The storage independent key of an object, relative to the storage root.
+	# output_id reads objects stored by another run (e.g. another training set's cascade)
+	def build_key(self, obj_type, locator, output_id=None):
+		if obj_type not in self.CACHE_TYPES:
+			return "output/%s/%s/%s" % (obj_type, output_id or self.output_id, locator)
+		return "cache/%s/%s" % (obj_type, locator)
+
+	# Path of one object relative to the folder holding objects of another type.
+	# Used for the sample lists opencv reads, which resolve paths relative to the list file.
+	def build_relative_path(self, obj_type, locator, relative_to_type):
+		relative_to = os.path.dirname(self.build_key(relative_to_type, "list"))
+		return os.path.relpath(self.build_key(obj_type, locator), relative_to)
+
+	def get(self, type, locator, output_id=None):
 		"""must be implemented by subclass"""
 		raise NotImplementedError
 
@@ -29,25 +50,83 @@ class AbstractStorage:
 		"""must be implemented by subclass"""
 		raise NotImplementedError
 
+	def put_many(self, obj_type, items, overwrite=False):
+		"""stores a list of (locator, obj) pairs, returns the put() result for each"""
+		return [self.put(obj_type, locator, obj, overwrite) for locator, obj in items]
+
+	def delete(self, obj_type, locator):
+		"""must be implemented by subclass, removing an object that doesn't exist is not an error"""
+		raise NotImplementedError
+
+	def get_local_filename(self, obj_type, locator, output_id=None):
+		"""must be implemented by subclass, for libraries that can only read files (e.g. OpenCV cascades)"""
+		raise NotImplementedError
+
+	def flush(self):
+		"""blocks until all outstanding writes are stored"""
+		pass
+
 class LocalStorage(AbstractStorage):
 
-	def __init__(self, output_id):
-		self.output_id 	= output_id
+	# Writes are handed to a background thread (write-behind) so callers never
+	# wait on the disk. Queued data is held in memory until it has been written,
+	# so put() blocks once more than MAX_PENDING_BYTES are waiting.
+	MAX_PENDING_BYTES	= 128 * 1024 * 1024
+	# Number of queued writes that share a single round of fsync calls
+	FSYNC_BATCH			= 64
+	# Concurrent puts for the same key are serialised by one of this many locks
+	KEY_LOCKS			= 64
 
-	def build_filename(self, obj_type, locator):
-		if obj_type not in ["bing_raw"]:
-			filename = os.path.abspath(os.path.join(os.path.dirname(__file__), "../output/%s/%s/%s" % (obj_type, self.output_id, locator)))
-		else:
-			filename = os.path.abspath(os.path.join(os.path.dirname(__file__), "../cache/%s/%s" % (obj_type, locator)))
+	def __init__(self, output_id, write_behind=True, root=None):
+		self.output_id 		= output_id
+		self.write_behind	= write_behind
+		if root is None:
+			root = os.path.join(os.path.dirname(__file__), "..")
+		self.root			= os.path.abspath(root)
+
+		# filename -> data for writes that have been queued but not yet renamed into place
+		self._pending		= {}
+		self._pending_bytes	= 0
+		self._pending_cond	= threading.Condition()
+		self._queue			= Queue.Queue()
+		self._writer		= None
+		self._writer_lock	= threading.Lock()
+		# Errors from background writes, raised by the next flush()
+		self._write_errors	= []
+
+		# Filenames are hashed onto a fixed set of locks so concurrent puts for the same key don't race
+		self._key_locks		= [threading.Lock() for index in range(self.KEY_LOCKS)]
+		self._known_dirs	= set()
+
+		atexit.register(self.flush)
 
+	def build_filename(self, obj_type, locator, output_id=None):
+		return os.path.join(self.root, self.build_key(obj_type, locator, output_id))
+
+	def get_local_filename(self, obj_type, locator, output_id=None):
+		filename = self.build_filename(obj_type, locator, output_id)
+
+		# The file has to be on disk before anything else can open it
+		with self._pending_cond:
+			while filename in self._pending:
+				self._pending_cond.wait(0.1)
+
+		if not os.path.isfile(filename):
+			return None
 		return filename
 
-	def get(self, obj_type, locator):
-		filename = self.build_filename(obj_type, locator)
+	def get(self, obj_type, locator, output_id=None):
+		filename = self.build_filename(obj_type, locator, output_id)
+
+		# Serve writes that are still queued so callers always read their own writes
+		with self._pending_cond:
+			if filename in self._pending:
+				return self._pending[filename]
+
 		if not os.path.isfile(filename):
 			return None
 
-		with open(filename) as f:
+		with open(filename, 'rb') as f:
 			data = f.read()
 		return data
 
@@ -55,20 +134,170 @@ class LocalStorage(AbstractStorage):
 
 		filename = self.build_filename(obj_type, locator)
 
-		if not os.path.exists(os.path.dirname(filename)):
-			try:
-				os.makedirs(os.path.dirname(filename))
-			except Exception, e:
-				logging.warn('Error creating directory: %s' % e)
-				pass
+		# Callers are allowed to write to the returned path directly, so the
+		# directory must exist before put() returns
+		self._makedirs(os.path.dirname(filename))
 
 		if obj:
-			if os.path.isfile(filename) and overwrite is False:
-				return filename
-			else:
-				out_file = file(filename, "w")
-				out_file.write(obj)
-				out_file.flush()
-				out_file.close()
+			with self._key_lock(filename):
+				if overwrite is False and self._exists(filename):
+					return filename
+
+				if self.write_behind:
+					self._enqueue(filename, obj)
+				else:
+					self._write_atomic([(filename, obj)])
 
 		return filename
+
+	def delete(self, obj_type, locator):
+		filename = self.build_filename(obj_type, locator)
+
+		with self._key_lock(filename):
+			# Let a queued write land first, otherwise it would bring the file back
+			with self._pending_cond:
+				while filename in self._pending:
+					self._pending_cond.wait(0.1)
+
+			try:
+				os.remove(filename)
+			except OSError, e:
+				if e.errno != errno.ENOENT:
+					raise
+
+	# Blocks until every queued write has been committed to disk, raises the
+	# first error of any write that failed since the last flush
+	def flush(self):
+		with self._pending_cond:
+			while self._pending:
+				self._pending_cond.wait(0.1)
+
+			errors, self._write_errors = self._write_errors, []
+
+		if errors:
+			raise errors[0]
+
+	def _exists(self, filename):
+		with self._pending_cond:
+			if filename in self._pending:
+				return True
+		return os.path.isfile(filename)
+
+	def _key_lock(self, filename):
+		return self._key_locks[hash(filename) % len(self._key_locks)]
+
+	def _makedirs(self, dirname):
+		if dirname in self._known_dirs:
+			return
+
+		try:
+			os.makedirs(dirname)
+		except OSError, e:
+			# Another worker may have created it first
+			if e.errno != errno.EEXIST:
+				logging.warn('Error creating directory: %s' % e)
+				return
+
+		self._known_dirs.add(dirname)
+
+	def _enqueue(self, filename, obj):
+		self._start_writer()
+
+		with self._pending_cond:
+			while self._pending and self._pending_bytes + len(obj) > self.MAX_PENDING_BYTES:
+				self._pending_cond.wait()
+
+			if filename in self._pending:
+				self._pending_bytes -= len(self._pending[filename])
+			self._pending[filename]	= obj
+			self._pending_bytes		+= len(obj)
+
+		self._queue.put(filename)
+
+	def _start_writer(self):
+		with self._writer_lock:
+			if self._writer is None or not self._writer.is_alive():
+				self._writer = threading.Thread(target=self._write_loop, name='LocalStorageWriter')
+				self._writer.daemon = True
+				self._writer.start()
+
+	# Background thread: drains the queue in batches and commits each batch
+	def _write_loop(self):
+		while True:
+			filenames = [self._queue.get()]
+			while len(filenames) < self.FSYNC_BATCH:
+				try:
+					filenames.append(self._queue.get_nowait())
+				except Queue.Empty:
+					break
+
+			with self._pending_cond:
+				# A key can be queued more than once if it was overwritten, only the latest data is kept
+				batch = [(filename, self._pending[filename]) for filename in set(filenames) if filename in self._pending]
+
+			error = None
+			try:
+				self._write_atomic(batch)
+			except Exception, e:
+				logging.error('Error writing to storage: %s' % e)
+				error = e
+
+			with self._pending_cond:
+				if error is not None:
+					self._write_errors.append(error)
+				for filename, obj in batch:
+					# Only release the entry if it wasn't replaced while we were writing
+					if self._pending.get(filename) is obj:
+						del self._pending[filename]
+						self._pending_bytes -= len(obj)
+				self._pending_cond.notify_all()
+
+	# Writes each file to a temporary file in the same directory, fsyncs the
+	# whole batch, then renames into place so readers never see partial files
+	def _write_atomic(self, batch):
+		open_files = []
+		try:
+			for filename, obj in batch:
+				fd, tmp_filename = tempfile.mkstemp(dir=os.path.dirname(filename), prefix='.%s.' % os.path.basename(filename), suffix='.tmp')
+				open_files.append((filename, tmp_filename, fd))
+				# mkstemp creates files readable only by the owner
+				os.fchmod(fd, 0o644)
+
+				written = 0
+				while written < len(obj):
+					written += os.write(fd, obj[written:])
+
+			while open_files:
+				filename, tmp_filename, fd = open_files[0]
+				try:
+					os.fsync(fd)
+				finally:
+					os.close(fd)
+					open_files[0] = (filename, tmp_filename, None)
+				# Only forget the temporary file once it has been renamed into place
+				os.rename(tmp_filename, filename)
+				open_files.pop(0)
+
+			for dirname in set(os.path.dirname(filename) for filename, obj in batch):
+				self._fsync_dir(dirname)
+		finally:
+			# Anything left over failed part way through, don't leave temporary files behind
+			for filename, tmp_filename, fd in open_files:
+				if fd is not None:
+					os.close(fd)
+				try:
+					os.remove(tmp_filename)
+				except OSError:
+					pass
+
+	def _fsync_dir(self, dirname):
+		try:
+			fd = os.open(dirname, os.O_RDONLY)
+		except OSError:
+			return
+		try:
+			os.fsync(fd)
+		except OSError:
+			pass
+		finally:
+			os.close(fd)
@@ -0,0 +1,56 @@
+import cv2
+import numpy
+from PIL import Image
+from mapping.tilemanager import AbstractTileManager
+
+# A synthetic imagery source and detector, so detection runs can be compared
+# without network access or a trained cascade.
+
+TILE_SIZE   = 256
+# Buildings are laid out one per cell of this size (in TMS pixels)
+CELL_SIZE   = 160
+
+# Bright rectangles ('buildings') on a dark background. Every building lies in
+# its own CELL_SIZE cell of the global pixel grid, with a size and position
+# derived from the cell, so neighbouring tiles always agree and buildings cross
+# tile and rectangle edges.
+class SyntheticTileManager(AbstractTileManager):
+
+    def __init__(self, seed=0):
+        self.seed   = seed
+
+    # (left, bottom, right, top) of the building in the cell, in TMS pixels (origin bottom left)
+    def building(self, cell_x, cell_y):
+        random  = numpy.random.RandomState([self.seed, cell_x % 100000, cell_y % 100000])
+        width   = random.randint(55, 140)
+        height  = random.randint(55, 140)
+        left    = cell_x * CELL_SIZE + random.randint(5, CELL_SIZE - 5 - width)
+        bottom  = cell_y * CELL_SIZE + random.randint(5, CELL_SIZE - 5 - height)
+        return left, bottom, left + width, bottom + height
+
+    def get_tile(self, x, y, zoom):
+        pixels = numpy.full((TILE_SIZE, TILE_SIZE, 3), 40, dtype=numpy.uint8)
+
+        # Tile row 0 is the top of the tile, TMS pixel y = (y + 1) * TILE_SIZE - 1
+        tile_left, tile_bottom = x * TILE_SIZE, y * TILE_SIZE
+        for cell_x in range(tile_left // CELL_SIZE - 1, (tile_left + TILE_SIZE) // CELL_SIZE + 1):
+            for cell_y in range(tile_bottom // CELL_SIZE - 1, (tile_bottom + TILE_SIZE) // CELL_SIZE + 1):
+                left, bottom, right, top = self.building(cell_x, cell_y)
+                col_start, col_end = max(left - tile_left, 0), min(right - tile_left, TILE_SIZE)
+                row_start, row_end = max(tile_bottom + TILE_SIZE - top, 0), min(tile_bottom + TILE_SIZE - bottom, TILE_SIZE)
+                if col_start < col_end and row_start < row_end:
+                    pixels[row_start:row_end, col_start:col_end] = 220
+
+        return Image.fromarray(pixels)
+
+
+# Stands in for CascadeEngine: every bright connected area is a detection,
+# clipped to the image like a cascade's windows are
+class BrightAreaEngine(object):
+
+    cascade_hash = 'bright_area'
+
+    def detect(self, image):
+        gray = cv2.cvtColor(numpy.asarray(image), cv2.COLOR_RGB2GRAY)
+        count, labels, stats, centroids = cv2.connectedComponentsWithStats((gray > 128).astype(numpy.uint8))
+        return stats[1:, :4].astype(numpy.int32)
@@ -0,0 +1,54 @@
+import os
+import unittest
+import cv2
+import numpy
+from detection.cascadeengine import CascadeEngine
+
+# OpenCV's 24x24 cascades, the window size train.sh trains with
+CASCADES = [
+    'haarcascade_frontalface_default.xml',
+    'haarcascade_frontalcatface.xml',
+    'haarcascade_frontalcatface_extended.xml'
+    ]
+
+
+class CascadeEngineTest(unittest.TestCase):
+
+    SCALE_FACTOR    = 1.05
+    MIN_SIZE        = (24, 24)
+    MAX_SIZE        = (150, 150)
+
+    def setUp(self):
+        # Blurred noise makes these cascades accept plenty of (overlapping) windows
+        random      = numpy.random.RandomState(0)
+        self.gray   = cv2.GaussianBlur((random.rand(480, 480) * 255).astype(numpy.uint8), (0, 0), 2)
+
+    def _cascadeFilename(self, name):
+        return os.path.join(os.path.dirname(cv2.__file__), 'data', name)
+
+    # The candidates grouped by the engine must be what detectMultiScale returns
+    # for the same pyramid, for every cascade, MIN_NEIGHBORS and pyramid setting
+    def testGroupedCandidatesMatchDetectMultiScale(self):
+        detections_found = 0
+        for name in CASCADES:
+            cascade = cv2.CascadeClassifier(self._cascadeFilename(name))
+            self.assertFalse(cascade.empty(), name)
+
+            for bound_pyramid in [True, False]:
+                engine              = CascadeEngine(self._cascadeFilename(name), self.SCALE_FACTOR, 0, self.MIN_SIZE, self.MAX_SIZE, bound_pyramid=bound_pyramid)
+                min_size, max_size  = engine.pyramidSizes()
+                candidates          = engine.rawCandidates(self.gray)
+                self.assertTrue(len(candidates) > 0, name)
+
+                for min_neighbors in [1, 2, 3]:
+                    detections, neighbors = candidates.group(min_neighbors)
+                    expected = cascade.detectMultiScale(self.gray, scaleFactor=self.SCALE_FACTOR, minNeighbors=min_neighbors, minSize=min_size, maxSize=max_size)
+
+                    self.assertEqual(sorted(map(tuple, detections)), sorted(map(tuple, numpy.asarray(expected).reshape(-1, 4))), "%s bound_pyramid=%s min_neighbors=%i" % (name, bound_pyramid, min_neighbors))
+                    detections_found += len(detections)
+
+        self.assertTrue(detections_found > 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+import shutil
+import tempfile
+import unittest
+from storage.storagemanager import initStorageManager, getStorageManager, LocalStorage
+from storage.resultstore import ResultStore
+from mapping.tilemanager import MemoryTileManager
+from detect import Detect
+from tests.synthetic import SyntheticTileManager, BrightAreaEngine, CELL_SIZE
+
+# Rectangles (in the order processTiles reads them). The first two overlap, the third is apart from them.
+RECTANGLES = [
+    [45.3900, -75.7000, 45.3920, -75.6975],
+    [45.3912, -75.6990, 45.3935, -75.6962],
+    [45.3960, -75.6940, 45.3975, -75.6925]
+    ]
+
+
+class SyntheticDetect(Detect):
+
+    RECORD_RESULTS = False
+
+    def _loadEngine(self, train_id):
+        return BrightAreaEngine()
+
+
+# Counts the tiles read from the synthetic imagery
+class CountingTileManager(SyntheticTileManager):
+
+    def __init__(self):
+        SyntheticTileManager.__init__(self)
+        self.reads = 0
+
+    def get_tile(self, x, y, zoom):
+        self.reads += 1
+        return SyntheticTileManager.get_tile(self, x, y, zoom)
+
+
+class DetectPlanTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='detect_test_')
+        initStorageManager('test', LocalStorage('test', root=self.root))
+
+    def tearDown(self):
+        getStorageManager().flush()
+        shutil.rmtree(self.root)
+
+    def _detect(self, rectangles, incremental):
+        detect              = SyntheticDetect(SyntheticTileManager())
+        detect.INCREMENTAL  = incremental
+        return [sorted(tuple(int(value) for value in building) for building in buildings) for tile_coords, buildings in detect.processTiles(rectangles)]
+
+    # Each rectangle run on its own, the reference the planned runs must match
+    def _detectSeparately(self, rectangles):
+        return [self._detect([rectangle], False)[0] for rectangle in rectangles]
+
+    def testIncrementalMatchesPerRectangleRun(self):
+        expected = self._detectSeparately(RECTANGLES)
+        self.assertTrue(all(len(buildings) > 0 for buildings in expected))
+
+        self.assertEqual(self._detect(RECTANGLES, True), expected)
+        # A second run is served from the stored tile results
+        self.assertEqual(self._detect(RECTANGLES, True), expected)
+
+    def testPlannedMatchesPerRectangleRun(self):
+        self.assertEqual(self._detect(RECTANGLES, False), self._detectSeparately(RECTANGLES))
+
+    def testOverlappingRectanglesRecordEachBuildingOnce(self):
+        for incremental in [False, True]:
+            results             = ResultStore(tempfile.mktemp(suffix='.sqlite', dir=self.root))
+            detect              = SyntheticDetect(SyntheticTileManager())
+            detect.RECORD_RESULTS = True
+            detect.INCREMENTAL  = incremental
+            detect.results      = results
+
+            output = detect.processTiles(RECTANGLES[:2])
+
+            # Every synthetic building is in its own cell, so the cells identify the buildings
+            cells_found = []
+            for tile_coords, buildings in output:
+                detect.map_generator.set_tile_coords(tile_coords)
+                cells_found.append(set(((detect.map_generator.ll_p_x + left + width // 2) // CELL_SIZE, (detect.map_generator.ur_p_y - top - height // 2) // CELL_SIZE) for left, top, width, height in buildings))
+
+            self.assertTrue(cells_found[0] & cells_found[1], "the rectangles should share buildings")
+
+            stats = results.stats()
+            self.assertEqual(len(stats), 1)
+            self.assertEqual(stats[0]['detections'], len(cells_found[0] | cells_found[1]))
+            results.close()
+
+    def testImagesOnlyWrittenWhenAsked(self):
+        storagemanager = getStorageManager()
+        for write_images in [False, True]:
+            detect              = SyntheticDetect(SyntheticTileManager())
+            detect.INCREMENTAL  = False
+            tile_coords         = detect.processTiles(RECTANGLES[:1], write_images=write_images)[0][0]
+
+            name = detect._getOutputName(tile_coords)
+            self.assertTrue(storagemanager.get_local_filename("detector_output", "%s.xml" % name) is not None)
+            self.assertEqual(storagemanager.get_local_filename("detector_output", "%s.png" % name) is not None, write_images)
+
+    def testMemoryTileManagerServesRepeatedRuns(self):
+        tile_manager        = CountingTileManager()
+        detect              = SyntheticDetect(MemoryTileManager(tile_manager))
+        detect.INCREMENTAL  = False
+
+        expected = self._detectSeparately(RECTANGLES)
+        detected = lambda: [sorted(tuple(int(value) for value in building) for building in buildings) for tile_coords, buildings in detect.processTiles(RECTANGLES, write_images=False)]
+
+        self.assertEqual(detected(), expected)
+        reads = tile_manager.reads
+        self.assertTrue(reads > 0)
+
+        # The second run finds every tile in memory
+        self.assertEqual(detected(), expected)
+        self.assertEqual(tile_manager.reads, reads)
+        detect.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,10 +1,13 @@
+import json
 import logging
+import hashlib
+import multiprocessing
 import cv2
 import numpy
 import cStringIO
-import django.contrib.gis.geos.collections
 from mapping.tilemanager import StaticMapGenerator
 from mapping.osmmanager import OSMManager
+from mapping.tileplan import TilePlan
 from storage.storagemanager import getStorageManager
 
 # This class generates the training samples using Bing Maps and OSM building data
@@ -16,26 +19,93 @@ from storage.storagemanager import getStorageManager
 # Negative sample = anything that's not a building (trees, water, etc)
 class Train():
 
-    def __init__(self):
-        self.map_generator          = StaticMapGenerator([19]) # TODO: Assuming zoom level 19 is available
+    # Negative samples are square windows of these sizes, taken from anywhere in
+    # the image that doesn't overlap a building
+    NEGATIVE_SIZES          = [256, 128, 64]
+    NEGATIVE_STRIDE         = 0.5   # Distance between candidate windows, as a fraction of the window size
+    MAX_NEGATIVES_PER_SIZE  = 100   # Per tile, picked at random from the candidates
+    NEGATIVE_MARGIN         = 4     # Pixels kept clear around each building (OSM outlines are not exact)
+
+    # Number of rectangles prepared at once, in separate processes (None = one per CPU)
+    PROCESSES               = None
+
+    def __init__(self, tile_manager=None, zoom=19):
+        self.map_generator          = StaticMapGenerator([zoom], tile_manager=tile_manager)
         self.osmmanager             = OSMManager()
         self.storagemanager         = getStorageManager()
 
-    # Process a list of map tiles
+    # Process a list of map tiles. Each rectangle's samples are written to files
+    # named after its coordinates, then combined into positives.dat and
+    # negatives.txt (the files train.sh uses) and a manifest of the rectangles.
     def processTiles(self, tiles):
 
-        tile_count = 1
-
+        # Fetch the imagery for every tile up front so tiles shared by overlapping rectangles are only downloaded once
+        tiles_coords = []
         for tile in tiles:
-
             min_lon, min_lat, max_lon, max_lat = [float(x) for x in tile]
-            positive_images, negative_images = self.processTile(tile_count, min_lat, min_lon, max_lat, max_lon)
-
-            # Write training data to file
-            self.storagemanager.put("classifier_input", "positives_%s.dat" % tile_count, ''.join(positive_images),   overwrite=True)
-            self.storagemanager.put("classifier_input", "negatives_%s.txt" % tile_count, '\n'.join(negative_images), overwrite=True)
-
-            tile_count = tile_count + 1
+            tiles_coords.append(self.map_generator.coords_to_ltrb(((min_lat, min_lon),(max_lat, max_lon)), left=180, right=-180, top=180, bottom=-180))
+
+        TilePlan(self.map_generator, tiles_coords).prefetch(self.map_generator.get_tile_manager())
+
+        jobs = [(self._getTileKey(tile_coords), [float(x) for x in tile]) for tile, tile_coords in zip(tiles, tiles_coords)]
+
+        if self.PROCESSES == 1 or len(jobs) == 1:
+            results = [self._processJob(job) for job in jobs]
+        else:
+            # Make sure nothing is mid-write when the workers are forked
+            self.storagemanager.flush()
+
+            global _train
+            _train = self
+            pool = multiprocessing.Pool(min(self.PROCESSES or multiprocessing.cpu_count(), len(jobs)))
+            try:
+                results = pool.map(_processJob, jobs)
+            finally:
+                pool.close()
+                pool.join()
+
+        self._writeManifest(tiles_coords, results)
+
+    # Prepares one rectangle and writes its samples. Returns (tile_key, positive data, negative data).
+    def _processJob(self, job):
+        tile_key, (min_lon, min_lat, max_lon, max_lat) = job
+        positive_images, negative_images = self.processTile(tile_key, min_lat, min_lon, max_lat, max_lon)
+
+        # Write training data to file
+        positive_data = ''.join(positive_images)
+        # One path per line. opencv_traincascade stops reading at the first blank
+        # line, so the combined negatives.txt must not have any between rectangles
+        negative_data = ''.join(path + '\n' for path in negative_images)
+        self.storagemanager.put("classifier_input", "positives_%s.dat" % tile_key, positive_data, overwrite=True)
+        self.storagemanager.put("classifier_input", "negatives_%s.txt" % tile_key, negative_data, overwrite=True)
+
+        # Worker processes don't run exit handlers, so everything is written before returning
+        self.storagemanager.flush()
+
+        return tile_key, positive_data, negative_data
+
+    # Writes the combined sample lists (in the order the rectangles were given)
+    # then the manifest. Each file replaces the previous one in a single step.
+    def _writeManifest(self, tiles_coords, results):
+        self.storagemanager.put("classifier_input", "positives.dat", ''.join(positive_data for tile_key, positive_data, negative_data in results), overwrite=True)
+        self.storagemanager.put("classifier_input", "negatives.txt", ''.join(negative_data for tile_key, positive_data, negative_data in results), overwrite=True)
+
+        manifest = []
+        for tile_coords, (tile_key, positive_data, negative_data) in zip(tiles_coords, results):
+            manifest.append({
+                'tile_key'      : tile_key,
+                'tile_coords'   : list(tile_coords),
+                'positives'     : "positives_%s.dat" % tile_key,
+                'negatives'     : "negatives_%s.txt" % tile_key
+                })
+        self.storagemanager.put("classifier_input", "manifest.json", json.dumps(manifest, indent=2), overwrite=True)
+        self.storagemanager.flush()
+
+        logging.info("Training data for %i tiles written to positives.dat and negatives.txt" % len(results))
+
+    # A short name for a rectangle that doesn't depend on the order rectangles are processed in
+    def _getTileKey(self, tile_coords):
+        return hashlib.md5(','.join(str(item) for item in tile_coords)).hexdigest()[:12]
 
     # Build training data using the rectangle created by the GPS coords min_lat, min_lon, max_lat, max_lon
     def processTile(self, tile_id, min_lat, min_lon, max_lat, max_lon):
@@ -43,9 +113,11 @@ class Train():
         logging.info("Downloading satellite imagery for tile %s" % tile_id)
 
         tile_coords             = self.map_generator.coords_to_ltrb(((min_lat, min_lon),(max_lat, max_lon)), left=180, right=-180, top=180, bottom=-180)
-        tile_image              = self.map_generator.get_tile_image(tile_coords)
-        tile_image_filename     = ','.join(str(item) for item in tile_coords)
-        tile_image_loc          = self.storagemanager.build_filename('bing_tiles', "%s.png" % (tile_image_filename))
+        # opencv_createsamples needs the mosaic as an image file
+        tile_image              = self.map_generator.get_tile_image(tile_coords, export_png=True)
+        tile_image_filename     = self.map_generator.get_tile_image_name(tile_coords)
+        # opencv_createsamples reads this path relative to the positives file
+        tile_image_loc          = self.storagemanager.build_relative_path('bing_tiles', tile_image_filename, 'classifier_input')
 
         logging.info("Downloading OSM building data for tile %s" % tile_id)
         
@@ -58,15 +130,14 @@ class Train():
 
         logging.info("Generating negative training data for tile %s" % tile_id)
         
-        # These next three lines assume that OSM building data is complete. If any buildings are
+        # These next lines assume that OSM building data is complete. If any buildings are
         # missing from the OSM data they will get included with the negative samples and negatively 
         # affect the training of the algorithm.
         
-        # Change pixels of known houses to black so they don't get included in the negative output
-        for positive_coord in positive_coords:
-            tile_image.paste((0,0,0), positive_coord)
+        # Mark the pixels of known houses so they don't get included in the negative output
+        occupancy               = self._getOccupancy(tile_image, building_coords)
         # Generate negative training data
-        negative_images = self._getNegativeSamples(tile_id, tile_image)
+        negative_images = self._getNegativeSamples(tile_id, tile_image, occupancy)
 
         # Print out some useful stats
         logging.info("Tile %s stats: Positive Images: %s, Negative Images: %s" % (tile_id, len(positive_images), len(negative_images)))
@@ -80,67 +151,80 @@ class Train():
 
     # Get the positive training samples (i.e. the existing buildings in OSM)
     def _getPositiveSamples(self, tile_image_size, building_data):
-        
-        positive_images = []
-        positive_coords = []
 
-        # Loop though each building in the OSM data
-        for building in building_data:
-            positive_image = self._getPositiveSample(tile_image_size, building, positive_coords)
-            if positive_image is not None:
-                positive_images.append(positive_image)
+        # Left, top, right, bottom pixel locations of every building, as one array
+        positive_coords = self._getPositiveSample(tile_image_size, building_data)
+
+        # Sometimes OSM returns buildings that start beyond the tile. Skip these.
+        inside          = building_data.inside(positive_coords, tile_image_size)
 
+        positive_images = ["%i %i %i %i\t" % (ltrb[0], ltrb[1], ltrb[2] - ltrb[0], ltrb[3] - ltrb[1]) for ltrb in positive_coords[inside]]
         positive_images.insert(0, "%s\t" % len(positive_images))
 
         return (positive_images, positive_coords)
 
-    def _getPositiveSample(self, tile_image_size, building, positive_coords):
-        
-         for building_lat_lng in building.coords:
+    # Converts the lat, lon footprints into left, top, right, bottom pixel locations relative to the tile
+    def _getPositiveSample(self, tile_image_size, building_data):
+        return building_data.pixel_bboxes(self.map_generator, tile_image_size)
+
+    # uint8 mask of the pixels negatives must not overlap: the OSM buildings plus any
+    # part of the mosaic with no imagery (pure black)
+    def _getOccupancy(self, tile_image, building_data):
+        occupancy = building_data.rasterize(self.map_generator, tile_image.size, self.NEGATIVE_MARGIN)
+        occupancy[numpy.asarray(tile_image).max(axis=2) == 0] = 1
+        return occupancy
 
-            coords = []
-            # Convert the lat, lon coords into x, y relative to the tile
-            for lng, lat in building_lat_lng:
-                coords.append(self.map_generator.x_y_for_lat_long(lat, lng))
+    # Crop windows that don't overlap any building to use as negative training samples
+    def _getNegativeSamples(self, tile_id, tile_image, occupancy):
 
-            # Convert the x,y coords into left, top, right, bottom pixel locations
-            ltrb = self.map_generator.coords_to_ltrb(coords, top = tile_image_size[1], left = tile_image_size[0], returnInt=True)
+        negative_images = []
+        negative_crops  = []
 
-            positive_coords.append(ltrb)
+        for left, top, size in self._getNegativeWindows(tile_id, occupancy):
+            image_cropped = tile_image.crop((left, top, left + size, top + size))
 
-            # Sometimes OSM returns buildings that start beyond the tile. Skip these.
-            if ltrb[0] < 0 or ltrb[1] < 0 or ltrb[2] > tile_image_size[0] or ltrb[3] > tile_image_size[1]:
-                return
+            output_img_bytes = cStringIO.StringIO()
+            image_cropped.save(output_img_bytes, 'PNG')
+            negative_crops.append(("%s_%s_%s_%s.png" % (size, tile_id, top, left), output_img_bytes.getvalue()))
 
-            height = ltrb[3] - ltrb[1]
-            width = ltrb[2] - ltrb[0]
+        self.storagemanager.put_many("negative_input", negative_crops)
 
-            return "%i %i %i %i\t" % (ltrb[0], ltrb[1], width, height)
+        # opencv_traincascade reads these paths relative to the negatives file
+        for locator, negative_crop in negative_crops:
+            negative_images.append(self.storagemanager.build_relative_path("negative_input", locator, "classifier_input"))
 
-    # Split up the satellite image into squares to use as negative training samples
-    def _getNegativeSamples(self, tile_id, tile_image):
+        return negative_images
 
-        negative_images = []
+    # Returns (left, top, size) windows with no occupied pixels. Every candidate
+    # window on a grid is checked with four lookups into the integral image of the
+    # occupancy mask, so the cost per candidate is constant.
+    def _getNegativeWindows(self, tile_id, occupancy):
+        height, width   = occupancy.shape
+        integral        = cv2.integral(occupancy)
+        random          = numpy.random.RandomState(int(hashlib.md5(str(tile_id)).hexdigest()[:8], 16))
+
+        windows = []
+        for size in self.NEGATIVE_SIZES:
+            if size > width or size > height:
+                continue
+
+            step        = max(1, int(size * self.NEGATIVE_STRIDE))
+            tops, lefts = numpy.mgrid[0:height - size + 1:step, 0:width - size + 1:step]
+            tops, lefts = tops.ravel(), lefts.ravel()
+
+            occupied    = integral[tops + size, lefts + size] - integral[tops, lefts + size] - integral[tops + size, lefts] + integral[tops, lefts]
+            free        = numpy.flatnonzero(occupied == 0)
+
+            if len(free) > self.MAX_NEGATIVES_PER_SIZE:
+                free = numpy.sort(random.choice(free, self.MAX_NEGATIVES_PER_SIZE, replace=False))
 
-        # Default to using a block size of 256 pixels (bing maps used 256 pixel blocks)
-        SQUARE_SIZE = 256
-        SQUARE_WIDTH = tile_image.size[0] / SQUARE_SIZE
-        SQUARE_HEIGHT = tile_image.size[1] / SQUARE_SIZE
+            windows.extend((int(lefts[i]), int(tops[i]), size) for i in free)
 
-        i = 0
-        while i<SQUARE_HEIGHT:
-            j = 0
-            while j<SQUARE_WIDTH:
-                image_cropped = tile_image.crop((j*SQUARE_SIZE, i*SQUARE_SIZE, (j*SQUARE_SIZE)+(SQUARE_SIZE), (i*SQUARE_SIZE)+SQUARE_SIZE))
-            
-                output_img_bytes = cStringIO.StringIO()
-                image_cropped.save(output_img_bytes, 'PNG')
-                filename = self.storagemanager.put("negative_input", "%s_%s_%s_%s.png" % (SQUARE_SIZE, tile_id, i, j), output_img_bytes.getvalue())
-                negative_images.append(filename)
+        return windows
 
-                j += 1
-            i += 1
 
-        negative_images.append('\n')
+# Module level so it can be run in a worker process, which inherits _train when forked
+_train = None
 
-        return negative_images
\ No newline at end of file
+def _processJob(job):
+    return _train._processJob(job)
@@ -5,8 +5,11 @@ OUTPUT_ID=$1
 
 cd output/classifier_input/$OUTPUT_ID/
 
-find . -type f -name 'positives_*' -exec cat {} + > positives.dat
-find . -type f -name 'negatives_*' -exec cat {} + > negatives.txt
+# positives.dat and negatives.txt are written by main.py once every rectangle is done
+if [ ! -f positives.dat ] || [ ! -f negatives.txt ]; then
+  echo "No training data for $OUTPUT_ID, run main.py --type train first" >&2
+  exit 1
+fi
 
 # Calulate the number of positive and negative images 
 POS_NUM=$(< positives.dat tr -dc \\t | wc -c)